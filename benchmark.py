@@ -0,0 +1,389 @@
+import sys, os
+# SDL's dummy driver lets render_all run without a display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import argparse
+import gc
+import json
+import shelve
+import shutil
+import tempfile
+import timeit
+import types
+
+import game
+
+try:  # allocation figures need tracemalloc (Python 3.4+), without it only retained sizes are measured
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# shared with the rest of the program rather than held by what is measured
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+if hasattr(types, 'ClassType'):
+  SHARED_TYPES += (types.ClassType,)
+
+##############################
+# BENCHMARK SETTINGS
+##############################
+
+SEED = 1234
+MAX_DEPTH = 50
+# a regular level deep enough to be crowded, boss levels are every 5th
+BUSY_DEPTH = 12
+
+DEFAULT_RUNS = 50
+QUICK_RUNS = 5
+
+# how much slower than the baseline a benchmark may get before --compare fails
+DEFAULT_TOLERANCE = 1.25
+
+timer = timeit.default_timer
+
+################################
+# MEASUREMENT
+################################
+
+def percentile(samples, p):
+  # samples must already be sorted
+  index = int(round(p / 100.0 * (len(samples) - 1)))
+  return samples[index]
+
+def measure(name, func, runs, setup = None):
+  # time func() runs times, calling setup() before each run outside the timing
+  samples = []
+  for i in range(runs):
+    if setup is not None:
+      setup()
+    start = timer()
+    func()
+    samples.append(timer() - start)
+
+  allocated = None
+  if tracemalloc is not None:
+    # one more run to count the memory it allocates
+    if setup is not None:
+      setup()
+    tracemalloc.start()
+    func()
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  samples.sort()
+  return {
+    'name': name,
+    'runs': runs,
+    'mean': sum(samples) / len(samples),
+    'p50': percentile(samples, 50),
+    'p95': percentile(samples, 95),
+    'p99': percentile(samples, 99),
+    'max': samples[-1],
+    'allocated': allocated,
+  }
+
+#############################
+# FIXTURES
+#############################
+
+def setup_game(depth):
+  # a headless game with the player standing on a freshly built level
+  game.new_game(SEED)
+  # don't let the worker thread's pregeneration skew the timings
+  game.pending_level.take()
+  game.dungeon_level = depth
+  game.make_map()
+  game.initialize_fov()
+  game.recompute_fov()
+
+def settle_pregeneration():
+  # loading starts building the next level on a worker thread; wait for it
+  # outside the timing, so the threads of one run don't pile up into the next
+  if game.pending_level is not None:
+    game.pending_level.take()
+
+def restore_player():
+  # the monsters keep attacking, keep the player alive and playing
+  game.player.fighter.hp = game.player.fighter.max_hp
+  game.game_state = 'playing'
+
+def farthest_monster():
+  monsters = [obj for obj in game.objects if obj.fighter and obj != game.player]
+  if not monsters:
+    return None
+  return max(monsters, key = game.player.distance_to)
+
+#############################
+# BENCHMARKS
+#############################
+
+def bench_make_map(runs):
+  results = []
+  for depth in range(1, MAX_DEPTH + 1):
+    kind = 'boss' if depth % 5 == 0 else 'rooms'
+    results.append(measure('make_map depth %d (%s)' % (depth, kind),
+                           lambda: game.generate_level(SEED, depth, 1), runs))
+  return results
+
+def bench_render(runs):
+  if game.con is None:
+    game.init_console()
+  setup_game(BUSY_DEPTH)
+  game.mouse = game.libtcod.Mouse()
+
+  def force_fov():
+    game.fov_state = None
+
+  colors = [game.libtcod.Color(255, 255, 255), game.libtcod.Color(0, 0, 0)]
+  def recolor_player():
+    # one changed cell, sent on its own
+    colors.reverse()
+    game.player.color = colors[0]
+
+  return [measure('render_all with fov recompute', game.render_all, runs, force_fov),
+          measure('render_all without fov recompute', game.render_all, runs),
+          measure('render_all with one cell changed', game.render_all, runs, recolor_player)]
+
+def bench_turns(runs):
+  setup_game(BUSY_DEPTH)
+  results = [measure('ai turn (%d objects)' % len(game.objects),
+                     lambda: game.play_turn(('wait',)), runs, restore_player)]
+
+  results.append(measure('closest_monster', lambda: game.closest_monster(game.TORCH_RADIUS), runs))
+
+  target = farthest_monster()
+  if target is not None:
+    results.append(measure('line_of_sight', lambda: game.line_of_sight(game.player, target), runs))
+  return results + bench_busy_tick(runs)
+
+def bench_busy_tick(runs):
+  # one tick of every monster on the level awake and in sight of the player, as in a big fight
+  setup_game(BUSY_DEPTH)
+  game.visible_tiles = game.new_plane(game.map.width, game.map.height, True)
+  # the monsters step down it, build it outside the timing
+  game.player_distance_map()
+  now = game.turn * game.TURN_TICKS
+  start = [(obj, obj.x, obj.y) for obj in game.objects if obj.ai]
+
+  def wake_all():
+    # each run starts from the same places, with every monster due now
+    restore_player()
+    for (serial, (obj, x, y)) in enumerate(start):
+      game.object_index.move(obj, x, y)
+      obj.asleep = False
+      obj.ready_at = now
+      obj.serial = serial
+    game.scheduler = game.Scheduler(game.objects, now)
+
+  def tick():
+    game.scheduler.run_until(now)
+
+  return [measure('monster tick (%d awake)' % len(start), tick, runs, wake_all)]
+
+def shelve_save():
+  # the pickled save the binary format replaced, kept as a reference point
+  file = shelve.open('savegame', 'n')
+  file['map'] = game.map
+  file['objects'] = game.objects
+  file['player_index'] = game.objects.index(game.player)
+  file['stairs_index'] = game.objects.index(game.stairs)
+  file['dungeon_level'] = game.dungeon_level
+  file['seed'] = game.game_seed
+  file['inventory'] = game.inventory
+  file['game_msgs'] = game.game_msgs
+  file['game_state'] = game.game_state
+  file.close()
+
+def shelve_load():
+  file = shelve.open('savegame', 'r')
+  game.map = file['map']
+  game.objects = file['objects']
+  game.player = game.objects[file['player_index']]
+  game.stairs = game.objects[file['stairs_index']]
+  game.dungeon_level = file['dungeon_level']
+  game.seed_random_streams(file['seed'])
+  game.inventory = file['inventory']
+  game.game_msgs = file['game_msgs']
+  game.game_state = file['game_state']
+  file.close()
+
+  game.object_index = game.SpatialIndex(game.objects)
+  game.initialize_fov()
+  game.pending_level = None
+  game.start_pregeneration()
+
+def files_size(prefix):
+  # shelve may spread a save over several files depending on the dbm backend
+  names = [name for name in os.listdir('.') if name == prefix or name.startswith(prefix + '.')]
+  return sum(os.path.getsize(name) for name in names if name != game.SAVE_FILE)
+
+def bench_save_load(runs):
+  setup_game(BUSY_DEPTH)
+  results = [measure('save_game', game.save_game, runs),
+             measure('load_game', game.load_game, runs, settle_pregeneration),
+             measure('save_game + load_game', lambda: (game.save_game(), game.load_game()), runs, settle_pregeneration)]
+  results[0]['size'] = os.path.getsize(game.SAVE_FILE)
+
+  setup_game(BUSY_DEPTH)
+  legacy = [measure('shelve save', shelve_save, runs),
+            measure('shelve load', shelve_load, runs, settle_pregeneration),
+            measure('shelve save + load', lambda: (shelve_save(), shelve_load()), runs, settle_pregeneration)]
+  legacy[0]['size'] = files_size('savegame')
+  settle_pregeneration()
+  return results + legacy
+
+def bench_levels(runs):
+  # going back to a level that was already visited, and forth again
+  setup_game(1)
+  game.next_level()
+
+  def up_and_down():
+    game.previous_level()
+    game.next_level()
+
+  return [measure('previous_level + next_level', up_and_down, runs)]
+
+ENTITIES = 5000
+
+class Unslotted(object):
+  # holds its fields in a per-instance dict, the way every entity did before __slots__
+  pass
+
+def unslotted(obj):
+  plain = Unslotted()
+  plain.__dict__.update(obj.__getstate__())
+  return plain
+
+def build_monsters():
+  monsters = []
+  for i in range(ENTITIES):
+    fighter = game.Fighter(hp = 20, defense = 0, power = 4, xp = 35, death_function = game.monster_death)
+    monsters.append(game.Object(i % game.MAP_WIDTH, i % game.MAP_HEIGHT, 'w', 'Alien Weakling', game.libtcod.red,
+                                blocks = True, fighter = fighter, ai = game.BasicMonster()))
+  return monsters
+
+def build_unslotted_monsters():
+  # copies of build_monsters(), its timing includes building those first
+  legacy = []
+  for monster in build_monsters():
+    plain = unslotted(monster)
+    plain.fighter = unslotted(monster.fighter)
+    plain.fighter.owner = plain
+    legacy.append(plain)
+  return legacy
+
+def deep_size(root):
+  # bytes of root and everything it references, each object counted once
+  seen = set()
+  stack = [root]
+  total = 0
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+      continue
+    seen.add(id(obj))
+    total += sys.getsizeof(obj)
+    stack.extend(gc.get_referents(obj))
+  return total
+
+def retained(build):
+  # bytes still held by what build() returns; without tracemalloc, summed over what it references
+  if tracemalloc is None:
+    return deep_size(build())
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  kept = build()
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return after - before
+
+def bench_memory(runs):
+  # the same monsters held in slotted objects and in per-instance dicts
+  results = []
+  for (name, build) in (('slots', build_monsters), ('dicts', build_unslotted_monsters)):
+    result = measure('%d monsters (%s)' % (ENTITIES, name), build, min(runs, QUICK_RUNS))
+    result['allocated'] = retained(build)
+    results.append(result)
+  return results
+
+BENCHMARKS = [
+  ('make_map', bench_make_map),
+  ('render', bench_render),
+  ('turns', bench_turns),
+  ('save', bench_save_load),
+  ('levels', bench_levels),
+  ('memory', bench_memory),
+]
+
+#############################
+# REPORTING
+#############################
+
+def print_results(results):
+  print('%-40s %5s %10s %10s %10s %10s %12s %10s' % ('benchmark', 'runs', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms',
+        'alloc KiB', 'file KiB'))
+  for r in results:
+    allocated = '-' if r['allocated'] is None else '%.1f' % (r['allocated'] / 1024.0)
+    size = '-' if r.get('size') is None else '%.1f' % (r['size'] / 1024.0)
+    print('%-40s %5d %10.3f %10.3f %10.3f %10.3f %12s %10s' % (r['name'], r['runs'], r['mean'] * 1000,
+          r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000, allocated, size))
+  if tracemalloc is None:
+    print('\nalloc KiB: allocations are not measured on Python %d.%d, that needs tracemalloc (Python 3.4+);'
+          % sys.version_info[:2])
+    print('the memory group shows the size of what its objects reference instead')
+
+def compare(results, baseline_path, tolerance):
+  # names of the benchmarks whose mean got slower than the baseline allows
+  with open(baseline_path) as f:
+    baseline = dict((r['name'], r) for r in json.load(f))
+
+  regressions = []
+  for r in results:
+    old = baseline.get(r['name'])
+    if old is not None and r['mean'] > old['mean'] * tolerance:
+      regressions.append('%s: %.3f ms -> %.3f ms' % (r['name'], old['mean'] * 1000, r['mean'] * 1000))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description = "Time the hot paths of Mines of Nar'Gyl, headless.")
+  parser.add_argument('--quick', action = 'store_true', help = 'few runs per benchmark, for a smoke test')
+  parser.add_argument('--only', action = 'append', choices = [name for (name, bench) in BENCHMARKS],
+                      help = 'run only this group, may be repeated')
+  parser.add_argument('--json', help = 'write the results to this file')
+  parser.add_argument('--compare', help = 'fail if slower than the results in this file')
+  parser.add_argument('--tolerance', type = float, default = DEFAULT_TOLERANCE)
+  args = parser.parse_args()
+
+  runs = QUICK_RUNS if args.quick else DEFAULT_RUNS
+
+  # saves are written to the working directory, keep them out of the repository
+  cwd = os.getcwd()
+  workdir = tempfile.mkdtemp()
+  os.chdir(workdir)
+  try:
+    results = []
+    for (name, bench) in BENCHMARKS:
+      if args.only and name not in args.only:
+        continue
+      results.extend(bench(runs))
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+
+  print_results(results)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent = 2)
+
+  if args.compare:
+    regressions = compare(results, args.compare, args.tolerance)
+    if regressions:
+      print('\nslower than the baseline:')
+      for line in regressions:
+        print('  ' + line)
+      return 1
+
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -4,7 +4,20 @@ import sys, os
 import libtcodpy as libtcod
 import math
 import textwrap
-import shelve
+import struct
+import threading
+import zlib
+import atexit
+import shutil
+import tempfile
+import heapq
+from collections import OrderedDict, deque
+
+try:  # NumPy backs the tile planes when it is available
+  import numpy
+  numpy_available = True
+except ImportError:
+  numpy_available = False
 
 ##############################
 # INITIALIZATION
@@ -25,6 +38,11 @@ PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
+
+# messages kept for the history view, the oldest go past this
+MESSAGE_HISTORY = 1000
+HISTORY_WIDTH = 70
+HISTORY_HEIGHT = 40
 INVENTORY_WIDTH = 50
 CHARACTER_SCREEN_WIDTH = 30
 LEVEL_SCREEN_WIDTH = 40
@@ -34,7 +52,16 @@ color_dark_wall = libtcod.darker_grey
 color_light_ground = libtcod.Color(200, 180, 50)
 color_dark_ground = libtcod.dark_grey
 
+# objects are drawn in layers, each over the one before: what lies on the
+# floor, then items, monsters and the player on top
+LAYER_FLOOR = 0
+LAYER_ITEMS = 1
+LAYER_MONSTERS = 2
+LAYER_PLAYER = 3
+
 LIMIT_FPS = 20
+# a frame with up to this many changed map cells sends them one by one, more and the whole map goes at once
+DIRTY_CELL_LIMIT = 64
 
 # Parameters for the dungeon generator
 BOSS_ROOM_MAX_WIDTH = 50
@@ -65,15 +92,68 @@ LIGHTNING_DAMAGE = 30
 LIFESTEAL_RANGE = 8  
 LIFESTEAL_DAMAGE = 25
 
+# the steps to the eight tiles around one, straight ones first
+NEIGHBOURS = [(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1)]
+# what a diagonal step costs on the distance map from the player
+DIAGONAL_COST = 1.41
+
+# Mixed into the game seed to seed the AI's random stream
+AI_SEED_SALT = 0x5bd1e995
+
+# Save file
+SAVE_FILE = 'savegame.sav'
+SAVE_MAGIC = b'NARG'
+SAVE_VERSION = 5
+JOURNAL_FILE = 'savegame.log'
+# player turns between autosaves
+AUTOSAVE_TURNS = 20
+
+# bytes of compressed levels kept in memory before the least recently visited go to disk
+LEVEL_MEMORY_BUDGET = 256 * 1024
+
+# Scheduling: a creature at normal speed acts once every TURN_TICKS,
+# one at twice the speed twice as often
+TURN_TICKS = 100
+NORMAL_SPEED = 100
+
 ################################
 # CLASSES
 ################################
 
-
-class Object:
+class Slotted(object):
+  # base of the classes there are many of: their fields live in fixed __slots__
+  # instead of a dict per instance. They pickle as a dict of their fields; a
+  # pickle from before a field was added gets it from the class's DEFAULTS, and
+  # fields that have since been dropped are skipped
+  __slots__ = ()
+  DEFAULTS = {}
+
+  @classmethod
+  def fields(cls):
+    names = []
+    for klass in reversed(cls.__mro__):
+      names.extend(klass.__dict__.get('__slots__', ()))
+    return names
+
+  def __getstate__(self):
+    return dict((name, getattr(self, name)) for name in self.fields() if hasattr(self, name))
+
+  def __setstate__(self, state):
+    fields = self.fields()
+    for (name, value) in self.DEFAULTS.items():
+      setattr(self, name, value)
+    for (name, value) in state.items():
+      if name in fields:
+        setattr(self, name, value)
+
+class Object(Slotted):
+  __slots__ = ('always_visible', 'name', 'blocks', 'x', 'y', 'char', 'color', 'speed', 'asleep', 'ready_at', 'serial',
+               'item', 'equipment', 'fighter', 'ai', 'level')
+  DEFAULTS = {'speed': NORMAL_SPEED, 'asleep': True, 'ready_at': 0, 'serial': 0, 'level': None}
 
   # This is a generic object: player, monster, item, etc..
-  def __init__(self, x, y, char, name, color, blocks = False, always_visible = False, fighter=None, ai=None, item=None, equipment=None):
+  # level is the character level, only the player has one
+  def __init__(self, x, y, char, name, color, blocks = False, always_visible = False, fighter=None, ai=None, item=None, equipment=None, speed = NORMAL_SPEED, level = None):
     self.always_visible = always_visible
     self.name = name
     self.blocks = blocks
@@ -81,7 +161,14 @@ class Object:
     self.y = y
     self.char = char
     self.color = color
-    
+
+    # when the scheduler next lets it act; it starts asleep until the player sees it
+    self.speed = speed
+    self.asleep = True
+    self.ready_at = 0
+    self.serial = 0
+    self.level = level
+
     self.item = item
     if self.item:
       self.item.owner = self
@@ -104,8 +191,7 @@ class Object:
 
   def move(self, dx, dy):
     if not is_blocked(self.x + dx, self.y + dy):
-      self.x += dx
-      self.y += dy
+      object_index.move(self, self.x + dx, self.y + dy)
 
   def move_towards(self, target_x, target_y):
     # vector from the object to the target
@@ -118,13 +204,13 @@ class Object:
     dy = int(round(delta_y/distance))
 
 
-    if map[self.x + dx][self.y].blocked:
+    if map.blocked[self.x + dx][self.y]:
       if delta_y < 0:
         self.move(0, -1)
       elif delta_y > 0:
         self.move(0, 1)
 
-    elif map[self.x][self.y + dy].blocked:
+    elif map.blocked[self.x][self.y + dy]:
       if delta_x < 0:
         self.move(-1, 0)
       elif delta_x > 0:
@@ -133,6 +219,28 @@ class Object:
     else:
       self.move(dx, dy)
 
+  def move_towards_player(self):
+    # step down the shared distance map, which finds the way around walls
+    distances = player_distance_map()
+    distance = libtcod.dijkstra_get_distance(distances, self.x, self.y)
+    if distance < 0:
+      # no way to the player on the map, head straight for them
+      self.move_towards(player.x, player.y)
+      return
+
+    best = None
+    for (dx, dy) in NEIGHBOURS:
+      x = self.x + dx
+      y = self.y + dy
+      if not (0 <= x < map.width and 0 <= y < map.height) or is_blocked(x, y):
+        continue
+      step = libtcod.dijkstra_get_distance(distances, x, y)
+      if 0 <= step < distance:
+        best = (dx, dy)
+        distance = step
+
+    if best is not None:
+      self.move(*best)
 
   def distance_to(self, other):
     # return distance to another object
@@ -146,18 +254,29 @@ class Object:
     objects.remove(self)
     objects.insert(0, self)
 
-  def draw(self):
-    # Draw only if object is in the fov
-    if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or 
-         (self.always_visible and map[self.x][self.y].explored)):
-      libtcod.console_set_default_foreground(con, self.color)
-      libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
+  def shown(self):
+    # whether it is drawn: in the fov, or always visible on a tile the player has seen
+    return id(self) in visible_ids or (self.always_visible and map.explored[self.x][self.y])
 
-  def clear(self):
-    libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
+  def layer(self):
+    if self is player:
+      return LAYER_PLAYER
+    if self.fighter:
+      return LAYER_MONSTERS
+    if self.item:
+      return LAYER_ITEMS
+    return LAYER_FLOOR
+
+  def draw(self):
+    # only called for objects that are shown, see shown_objects
+    libtcod.console_set_default_foreground(con, self.color)
+    libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
 
-class Fighter:
+class Fighter(Slotted):
   # Combat related properties and methods
+  __slots__ = ('base_max_hp', 'hp', 'base_defense', 'base_power', 'xp', 'death_function', 'stats', 'owner')
+  DEFAULTS = {'stats': None}
+
   def __init__(self, hp, defense, power, xp, death_function = None):
     self.base_max_hp = hp
     self.hp = hp
@@ -165,26 +284,38 @@ class Fighter:
     self.base_power = power
     self.xp = xp
     self.death_function = death_function
- 
+    # base stats plus equipment bonuses, summed up again only after invalidate_stats
+    self.stats = None
+
+  def invalidate_stats(self):
+    self.stats = None
+
+  def total_stats(self):
+    if self.stats is None:
+      power, defense, max_hp, life_steal = self.base_power, self.base_defense, self.base_max_hp, 0
+      for equipment in get_all_equipped(self.owner):
+        power += equipment.power_bonus
+        defense += equipment.defense_bonus
+        max_hp += equipment.max_hp_bonus
+        life_steal += equipment.life_steal_bonus
+      self.stats = (power, defense, max_hp, life_steal)
+    return self.stats
+
   @property
   def power(self):
-    bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_power + bonus
+    return self.total_stats()[0]
 
   @property
   def defense(self):
-    bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_defense + bonus
+    return self.total_stats()[1]
 
   @property
   def max_hp(self):
-    bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_max_hp + bonus
+    return self.total_stats()[2]
 
   @property
   def life_steal(self):
-    bonus = sum(equipment.life_steal_bonus for equipment in get_all_equipped(self.owner))
-    return bonus
+    return self.total_stats()[3]
 
 
   def attack(self, target):
@@ -220,6 +351,7 @@ class Fighter:
 
 class Projectile:
   #AI for projectile
+  sleeps = False
 
   def __init__(self, target_x, target_y):
     self.target_x = target_x
@@ -233,19 +365,22 @@ class Projectile:
       player.take_damage(15)
       projectile.take_damage(1)
 
-    elif map[self.x][self.y].blocked:
+    elif map.blocked[self.x][self.y]:
       projectile.take_damage(1)
     
 class BasicMonster:
   #AI for a basic monster
+  # it only acts in sight of the player, so it can sleep out of it
+  sleeps = True
+
   def take_turn(self):
     # monster takes its turn. If you can see it, it can see you
     monster = self.owner
-    if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+    if in_fov(monster.x, monster.y):
 
       # move towards player if far away
       if monster.distance_to(player) >= 2:
-        monster.move_towards(player.x, player.y)
+        monster.move_towards_player()
       
       # now the monster is close enough to attack!
       elif player.fighter.hp > 0:
@@ -253,22 +388,26 @@ class BasicMonster:
 
 class BossMonster:
   # AI for bosses
+  sleeps = True
+
   def take_turn(self):
   
     boss = self.owner
-    if libtcod.map_is_in_fov(fov_map, boss.x, boss.y):
+    if in_fov(boss.x, boss.y):
       if boss.distance_to(player) >= 5:
         message('The ' + boss.name.capitalize() + ' begins casting Fireball!', libtcod.red)
         cast_fireball(boss.x, boss.y, player.x, player.y)
 
       elif boss.distance_to(player) >= 2:
-        boss.move_towards(player.x, player.y)
+        boss.move_towards_player()
 
       else:
         boss.fighter.attack(player)
 
 class ConfusedMonster:
   # AI for a temporarily confused monster
+  sleeps = False
+
   def __init__(self, old_ai, num_turns = CONFUSE_NUM_TURNS):
     self.old_ai = old_ai
     self.num_turns = num_turns
@@ -276,26 +415,184 @@ class ConfusedMonster:
   def take_turn(self):
     if self.num_turns > 0:
       # Move in a random direction until no longer confused
-      self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+      self.owner.move(libtcod.random_get_int(ai_rng, -1, 1), libtcod.random_get_int(ai_rng, -1, 1))
       self.num_turns -= 1
 
     else:
       self.owner.ai = self.old_ai
       message('The ' + self.owner.name + ' is no longer confused!', libtcod.red)
 
-class Tile:
-  # a tileof the map, and its properties
-  def __init__(self, blocked, block_sight = None):
+class TileType(object):
+  # a kind of terrain, shared by every tile of that kind and never changed once registered
+  __slots__ = ('name', 'blocked', 'block_sight', 'glyph', 'light', 'dark')
+
+  def __init__(self, name, blocked, block_sight, light, dark, glyph):
+    self.name = name
     self.blocked = blocked
+    self.block_sight = block_sight
+    self.light = light
+    self.dark = dark
+    self.glyph = glyph
+
+# every kind of terrain; a map holds the number of each tile's kind, and so do
+# saves, so new kinds must only ever be appended
+TILE_TYPES = []
+
+def register_tile_type(name, blocked, block_sight, light, dark, glyph = ' '):
+  # add a kind of terrain, returning its number
+  TILE_TYPES.append(TileType(name, blocked, block_sight, light, dark, glyph))
+  return len(TILE_TYPES) - 1
+
+TILE_ROCK = register_tile_type('rock', True, True, color_light_wall, color_dark_wall)
+TILE_FLOOR = register_tile_type('floor', False, False, color_light_ground, color_dark_ground)
+TILE_PILLAR = register_tile_type('pillar', True, True, color_light_wall, color_dark_wall)
+
+def tile_table(name):
+  # one field of every tile type as an array indexed by kind, so a whole plane of
+  # kinds is looked up at once; colours come out as (r, g, b) rows
+  table = tile_tables.get(name)
+  if table is None or len(table) != len(TILE_TYPES):
+    values = [getattr(tile_type, name) for tile_type in TILE_TYPES]
+    if isinstance(values[0], libtcod.Color):
+      values = [(color.r, color.g, color.b) for color in values]
+    elif isinstance(values[0], str):
+      values = [ord(glyph) for glyph in values]
+    table = tile_tables[name] = numpy.array(values)
+  return table
+
+tile_tables = {}
+
+def new_plane(width, height, value, dtype = bool):
+  # one property of every tile, indexed plane[x][y]
+  if numpy_available:
+    return numpy.full((width, height), value, dtype=dtype)
+  return [[value] * height for x in range(width)]
+
+class TileMap:
+  # the tiles of the map: the kind of each tile, a number into TILE_TYPES, and
+  # whether the player has seen it. blocked and block_sight are read tile by tile
+  # all the time, so they are kept as planes too, looked up again whenever a kind changes
+  def __init__(self, width, height, kind = TILE_ROCK):
+    self.width = width
+    self.height = height
+    tile_type = TILE_TYPES[kind]
+    self.kinds = new_plane(width, height, kind, 'uint8')
+    self.blocked = new_plane(width, height, tile_type.blocked)
+    self.block_sight = new_plane(width, height, tile_type.block_sight)
+    self.explored = new_plane(width, height, False)
+
+    # bumped on every terrain change; dirty holds the changed areas as (x1, x2, y1, y2)
+    self.version = 0
+    self.dirty = []
+
+  def __getitem__(self, x):
+    # keeps map[x][y].blocked style access working
+    return TileColumn(self, x)
+
+  def set_tile(self, x, y, kind):
+    tile_type = TILE_TYPES[kind]
+    self.kinds[x][y] = kind
+    self.blocked[x][y] = tile_type.blocked
+    self.block_sight[x][y] = tile_type.block_sight
+    self.mark_dirty(x, x + 1, y, y + 1)
+
+  def set_area(self, x1, x2, y1, y2, kind):
+    # set every tile with x1 <= x < x2 and y1 <= y < y2
+    tile_type = TILE_TYPES[kind]
+    if numpy_available:
+      self.kinds[x1:x2, y1:y2] = kind
+      self.blocked[x1:x2, y1:y2] = tile_type.blocked
+      self.block_sight[x1:x2, y1:y2] = tile_type.block_sight
+    else:
+      for x in range(x1, x2):
+        for y in range(y1, y2):
+          self.kinds[x][y] = kind
+          self.blocked[x][y] = tile_type.blocked
+          self.block_sight[x][y] = tile_type.block_sight
+    self.mark_dirty(x1, x2, y1, y2)
+
+  def set_kinds(self, kinds):
+    # replace every tile at once, as loading does
+    self.kinds = kinds
+    if numpy_available:
+      self.blocked = tile_table('blocked')[kinds]
+      self.block_sight = tile_table('block_sight')[kinds]
+    else:
+      self.blocked = [[TILE_TYPES[kind].blocked for kind in column] for column in kinds]
+      self.block_sight = [[TILE_TYPES[kind].block_sight for kind in column] for column in kinds]
+    self.mark_dirty(0, self.width, 0, self.height)
+
+  def mark_dirty(self, x1, x2, y1, y2):
+    self.version += 1
+    self.dirty.append((x1, x2, y1, y2))
+
+  def take_dirty(self):
+    # hand over the areas changed since the last call, and forget them
+    dirty = self.dirty
+    self.dirty = []
+    return dirty
+
+  def fov_properties(self):
+    # transparent and walkable flags in libtcod's row-major cell order, for map_fill_properties
+    if numpy_available:
+      return ~self.block_sight.T, ~self.blocked.T
+    transparent = [not self.block_sight[x][y] for y in range(self.height) for x in range(self.width)]
+    walkable = [not self.blocked[x][y] for y in range(self.height) for x in range(self.width)]
+    return transparent, walkable
+
+class TileColumn(object):
+  # a column of the map, only here to support map[x][y]
+  __slots__ = ('tile_map', 'x')
+
+  def __init__(self, tile_map, x):
+    self.tile_map = tile_map
+    self.x = x
 
-    self.explored = False
+  def __getitem__(self, y):
+    return Tile(self.tile_map, self.x, y)
 
-    # by default, if a tile is blocked, it also blocks sight
-    if block_sight is None: block_sight = blocked
-    self.block_sight = block_sight
+class Tile(object):
+  # a view of a single tile of the map, reading and writing the map's planes.
+  # Its terrain changes by setting its kind
+  __slots__ = ('tile_map', 'x', 'y')
+
+  def __init__(self, tile_map, x, y):
+    self.tile_map = tile_map
+    self.x = x
+    self.y = y
+
+  @property
+  def kind(self):
+    return int(self.tile_map.kinds[self.x][self.y])
+
+  @kind.setter
+  def kind(self, value):
+    self.tile_map.set_tile(self.x, self.y, value)
+
+  @property
+  def type(self):
+    return TILE_TYPES[self.kind]
+
+  @property
+  def blocked(self):
+    return bool(self.tile_map.blocked[self.x][self.y])
 
-class Equipment:
+  @property
+  def block_sight(self):
+    return bool(self.tile_map.block_sight[self.x][self.y])
+
+  @property
+  def explored(self):
+    return bool(self.tile_map.explored[self.x][self.y])
+
+  @explored.setter
+  def explored(self, value):
+    self.tile_map.explored[self.x][self.y] = value
+
+class Equipment(Slotted):
   # an object can be equipped granting bonuses and such
+  __slots__ = ('power_bonus', 'defense_bonus', 'max_hp_bonus', 'life_steal_bonus', 'slot', 'is_equipped', 'is_ranged', 'owner')
+
   def __init__(self, slot, is_ranged = False, power_bonus = 0, defense_bonus = 0, max_hp_bonus = 0, life_steal_bonus = 0):
     self.power_bonus = power_bonus
     self.defense_bonus = defense_bonus
@@ -318,6 +615,7 @@ class Equipment:
       old_equipment.dequip()
 
     self.is_equipped = True
+    equipment_changed()
     message('You have equipped ' + self.owner.name + '!', libtcod.light_green)
     self.owner.name += ' *'
 
@@ -325,6 +623,7 @@ class Equipment:
     if not self.is_equipped: return
 
     self.is_equipped = False
+    equipment_changed()
     self.owner.name = self.owner.name[0:-2]
     message('You are no longer using ' + self.owner.name + '!', libtcod.light_yellow)
     
@@ -334,6 +633,11 @@ def get_equipped_in_slot(slot):
       return obj.equipment
   return None
 
+def equipment_changed():
+  # the player's stats count what is equipped in their inventory
+  if player.fighter:
+    player.fighter.invalidate_stats()
+
 def get_all_equipped(obj):
   if obj == player:
     equipped_list = []
@@ -345,8 +649,10 @@ def get_all_equipped(obj):
   else:
     return []
 
-class Rect:
+class Rect(Slotted):
   # a rectangle on the map, used to define rooms or halls
+  __slots__ = ('x1', 'y1', 'x2', 'y2')
+
   def __init__(self, x, y, w, h):
     self.x1 = x
     self.y1 = y
@@ -361,8 +667,38 @@ class Rect:
   def intersect(self, other):
     return (self.x1 <= other.x2 and self.x2 >= other.x1 and self.y1 <= other.y2 and self.y2 >= other.y1)
 
-class Item:
-  
+class RoomIndex:
+  # files placed rooms under the grid buckets they cover, so an overlap test
+  # only compares against the rooms nearby instead of every room so far
+  def __init__(self, bucket_size = ROOM_MAX_SIZE + 1):
+    self.bucket_size = bucket_size
+    self.buckets = {}
+
+  def bucket_keys(self, rect):
+    size = self.bucket_size
+    for bx in range(rect.x1 // size, rect.x2 // size + 1):
+      for by in range(rect.y1 // size, rect.y2 // size + 1):
+        yield (bx, by)
+
+  def add(self, rect):
+    for key in self.bucket_keys(rect):
+      bucket = self.buckets.get(key)
+      if bucket is None:
+        self.buckets[key] = [rect]
+      else:
+        bucket.append(rect)
+
+  def intersects(self, rect):
+    # overlapping rooms always share at least one bucket
+    for key in self.bucket_keys(rect):
+      for other in self.buckets.get(key, ()):
+        if rect.intersect(other):
+          return True
+    return False
+
+class Item(Slotted):
+  __slots__ = ('use_function', 'collectable', 'owner')
+
   def __init__(self, collectable = True, use_function = None):
     self.use_function = use_function
     self.collectable = collectable
@@ -374,7 +710,8 @@ class Item:
     else:
       if self.collectable:
         inventory.append(self.owner)
-        objects.remove(self.owner)
+        equipment_changed()
+        remove_object(self.owner)
         message('You picked up a ' + self.owner.name + '!', libtcod.green)
 
         equipment = self.owner.equipment
@@ -384,10 +721,11 @@ class Item:
         message('That object is not collectable.', libtcod.red)
 
   def drop(self):
-    objects.append(self.owner)
     inventory.remove(self.owner)
+    equipment_changed()
     self.owner.x = player.x
     self.owner.y = player.y
+    add_object(self.owner)
     message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 
   def use(self):
@@ -400,6 +738,377 @@ class Item:
     else:
       if self.use_function() != 'cancelled':
         inventory.remove(self.owner)
+        equipment_changed()
+
+class SpatialIndex:
+  # maps (x, y) to the objects standing on that tile, so tile queries don't walk the whole objects list
+  def __init__(self, objects = ()):
+    self.cells = {}
+    for obj in objects:
+      self.add(obj)
+
+  def add(self, obj):
+    key = (obj.x, obj.y)
+    cell = self.cells.get(key)
+    if cell is None:
+      self.cells[key] = [obj]
+    else:
+      cell.append(obj)
+
+  def remove(self, obj):
+    key = (obj.x, obj.y)
+    cell = self.cells.get(key)
+    if cell is None or obj not in cell:
+      return
+    cell.remove(obj)
+    if not cell:
+      del self.cells[key]
+
+  def move(self, obj, x, y):
+    self.remove(obj)
+    obj.x = x
+    obj.y = y
+    self.add(obj)
+
+  def at(self, x, y):
+    # every object on the tile
+    return self.cells.get((x, y), ())
+
+  def blocker_at(self, x, y):
+    for obj in self.cells.get((x, y), ()):
+      if obj.blocks:
+        return obj
+    return None
+
+  def in_range(self, x, y, radius):
+    # objects inside the square of the given radius around (x, y)
+    # scans whichever is smaller: the occupied tiles or the square itself
+    side = 2 * radius + 1
+    found = []
+    if len(self.cells) < side * side:
+      for (cx, cy), cell in self.cells.items():
+        if abs(cx - x) <= radius and abs(cy - y) <= radius:
+          found.extend(cell)
+    else:
+      for cx in range(x - radius, x + radius + 1):
+        for cy in range(y - radius, y + radius + 1):
+          cell = self.cells.get((cx, cy))
+          if cell:
+            found.extend(cell)
+    return found
+
+class Level:
+  # a generated dungeon level: its tiles, its objects and where the player arrives
+  def __init__(self, dungeon_level, rng, player_level):
+    self.dungeon_level = dungeon_level
+    self.rng = rng
+    # monster stats scale with the player's level when the level is built
+    self.player_level = player_level
+
+    # fill map with 'blocked' tiles
+    self.map = TileMap(MAP_WIDTH, MAP_HEIGHT)
+    self.objects = []
+    self.object_index = SpatialIndex()
+    self.stairs = None
+    self.start_x = 0
+    self.start_y = 0
+
+  def is_blocked(self, x, y):
+    # the player will stand on the start tile
+    if x == self.start_x and y == self.start_y:
+      return True
+    return self.map.blocked[x][y] or self.object_index.blocker_at(x, y) is not None
+
+  def add_object(self, obj):
+    self.objects.append(obj)
+    self.object_index.add(obj)
+
+  def send_to_back(self, obj):
+    self.objects.remove(obj)
+    self.objects.insert(0, obj)
+
+class PendingLevel:
+  # a level being generated on a worker thread
+  def __init__(self, seed, depth, player_level):
+    self.key = (seed, depth, player_level)
+    self.level = None
+    self.thread = threading.Thread(target = self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    self.level = generate_level(*self.key)
+
+  def take(self):
+    # wait for the worker if the player got to the stairs first
+    self.thread.join()
+    return self.level
+
+class PendingSave:
+  # a serialized save being written to disk on a worker thread. The levels left
+  # behind are added there, those spilled to disk read back by the worker
+  def __init__(self, head, levels, path):
+    self.head = head
+    self.levels = levels
+    self.path = path
+    self.error = None
+    self.thread = threading.Thread(target = self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    try:
+      write_save(self.head + pack_level_records(self.levels), self.path)
+    except (IOError, OSError) as e:
+      self.error = e
+
+  def done(self):
+    return not self.thread.is_alive()
+
+  def finish(self):
+    self.thread.join()
+    return self.error
+
+class Scheduler:
+  # the awake monsters, ordered by when each acts next. A monster that can't
+  # see the player falls asleep and leaves the queue until wake_monsters sees it
+  def __init__(self, objects, now):
+    self.queue = []
+    self.serial = 0
+    for obj in objects:
+      if obj.ai and not obj.asleep:
+        # monsters of a level the player comes back to don't catch up on the time away
+        obj.ready_at = max(obj.ready_at, now)
+        self.queue.append((obj.ready_at, obj.serial, obj))
+        self.serial = max(self.serial, obj.serial + 1)
+    heapq.heapify(self.queue)
+
+  def push(self, obj, ready_at):
+    # the serial keeps monsters ready at the same time in the order they were queued
+    obj.ready_at = ready_at
+    obj.serial = self.serial
+    self.serial += 1
+    heapq.heappush(self.queue, (ready_at, obj.serial, obj))
+
+  def wake(self, obj, now):
+    obj.asleep = False
+    self.push(obj, now)
+
+  def run_until(self, now):
+    # every monster whose time has come acts, a fast one maybe more than once
+    queue = self.queue
+    while queue and queue[0][0] <= now:
+      (ready_at, serial, obj) = heapq.heappop(queue)
+      if obj.ai is None:
+        continue  # it died since it was queued
+
+      if obj.ai.sleeps and not in_fov(obj.x, obj.y):
+        obj.asleep = True
+        continue
+
+      obj.ai.take_turn()
+      self.push(obj, ready_at + TURN_TICKS * NORMAL_SPEED // obj.speed)
+
+class MessageLog:
+  # every message shown, up to the capacity, after which the oldest are dropped.
+  # Each message is wrapped once for every width it is shown at
+  def __init__(self, capacity = MESSAGE_HISTORY):
+    self.messages = deque(maxlen = capacity)
+    # every message ever added, counting those dropped, so a change shows even when full
+    self.added = 0
+
+  def __len__(self):
+    return len(self.messages)
+
+  def __iter__(self):
+    for (text, color, wrapped) in self.messages:
+      yield (text, color)
+
+  def add(self, text, color):
+    self.messages.append((text, color, {}))
+    self.added += 1
+
+  def lines(self, width, count, scroll = 0):
+    # count wrapped lines, oldest first, ending scroll lines above the newest
+    lines = []
+    for (text, color, wrapped) in reversed(self.messages):
+      if len(lines) >= count + scroll:
+        break
+      wrapped_lines = wrapped.get(width)
+      if wrapped_lines is None:
+        wrapped_lines = wrapped[width] = textwrap.wrap(text, width)
+      for line in reversed(wrapped_lines):
+        lines.append((line, color))
+
+    lines = lines[scroll:scroll + count]
+    lines.reverse()
+    return lines
+
+class Compositor:
+  # builds each frame of the map console in arrays, one layer over the other: the
+  # terrain, then the objects shown in render order. Only the cells that differ
+  # from the last frame sent go to libtcod, one by one when there are few, else
+  # the whole frame in three fill calls. Arrays are indexed [y, x] like the
+  # console, colours with the channel first, so each goes over as it is
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    # the terrain, painted again only when the fov changes
+    self.terrain_char = numpy.full((height, width), ord(' '), dtype=numpy.int32)
+    self.background = numpy.zeros((3, height, width), dtype=numpy.int32)
+    self.repainted = True
+    # the frame being built and the last one sent, swapped after each send
+    self.char = numpy.zeros((height, width), dtype=numpy.int32)
+    self.foreground = numpy.zeros((3, height, width), dtype=numpy.int32)
+    self.sent_char = numpy.zeros((height, width), dtype=numpy.int32)
+    self.sent_foreground = numpy.zeros((3, height, width), dtype=numpy.int32)
+    self.sent_background = numpy.zeros((3, height, width), dtype=numpy.int32)
+
+  def paint_terrain(self, tile_map, visible):
+    kinds = tile_map.kinds.T
+    explored = tile_map.explored.T
+    # the dark colour of every kind, then the light ones, so a cell in view indexes past the dark ones
+    palette = numpy.concatenate((tile_table('dark'), tile_table('light')))
+    colors = palette[kinds + len(TILE_TYPES) * visible.T]
+    chars = tile_table('glyph')[kinds]
+    # unexplored cells stay black and empty
+    colors[~explored] = 0
+    chars[~explored] = ord(' ')
+
+    self.background[:, :tile_map.height, :tile_map.width] = colors.transpose(2, 0, 1)
+    self.terrain_char[:tile_map.height, :tile_map.width] = chars
+    self.repainted = True
+
+  def present(self, console, shown, everything = False):
+    # the terrain with the shown objects over it; a later object covers an earlier one on the same tile.
+    # Returns the rectangle of the console that changed as (x, y, width, height), or None.
+    # everything sends the whole frame, for when the console no longer holds the last one
+    char = self.char
+    foreground = self.foreground
+    background = self.background
+    char[:] = self.terrain_char
+    foreground.fill(0)
+    if shown:
+      xs = [obj.x for obj in shown]
+      ys = [obj.y for obj in shown]
+      char[ys, xs] = [ord(obj.char) for obj in shown]
+      foreground[:, ys, xs] = numpy.array([(obj.color.r, obj.color.g, obj.color.b) for obj in shown]).T
+
+    if everything:
+      changed = numpy.ones((self.height, self.width), dtype=bool)
+    else:
+      changed = (char != self.sent_char) | (foreground != self.sent_foreground).any(axis=0)
+      if self.repainted:
+        changed |= (background != self.sent_background).any(axis=0)
+    if self.repainted:
+      self.sent_background[:] = background
+      self.repainted = False
+
+    (ys, xs) = numpy.nonzero(changed)
+    if len(xs) == 0:
+      return None
+
+    if len(xs) > DIRTY_CELL_LIMIT:
+      # objects leave the background as it is, like drawing them with BKGND_NONE did
+      libtcod.console_fill_char(console, char.ravel())
+      libtcod.console_fill_foreground(console, foreground[0].ravel(), foreground[1].ravel(), foreground[2].ravel())
+      libtcod.console_fill_background(console, background[0].ravel(), background[1].ravel(), background[2].ravel())
+    else:
+      for (x, y) in zip(xs.tolist(), ys.tolist()):
+        libtcod.console_put_char_ex(console, x, y, int(char[y, x]), libtcod.Color(*foreground[:, y, x].tolist()),
+                                    libtcod.Color(*background[:, y, x].tolist()))
+
+    self.char, self.sent_char = self.sent_char, char
+    self.foreground, self.sent_foreground = self.sent_foreground, foreground
+
+    x1, y1 = int(xs.min()), int(ys.min())
+    return (x1, y1, int(xs.max()) - x1 + 1, int(ys.max()) - y1 + 1)
+
+class LevelStore:
+  # the levels the player has left, packed and compressed, by depth.
+  # Beyond the memory budget the least recently visited are written to disk
+  def __init__(self, budget = LEVEL_MEMORY_BUDGET):
+    self.budget = budget
+    self.packed = OrderedDict()  # least recently visited first
+    self.size = 0
+    self.spilled = {}
+    self.directory = None
+    self.spills = 0
+    # while an autosave may be reading spilled files, those taken back are only removed after
+    self.shared = False
+    self.stale = []
+
+  def __contains__(self, depth):
+    return depth in self.packed or depth in self.spilled
+
+  def put(self, depth, data):
+    self.take(depth)
+    self.packed[depth] = data
+    self.size += len(data)
+
+    while self.size > self.budget and len(self.packed) > 1:
+      (old_depth, old_data) = self.packed.popitem(last = False)
+      self.size -= len(old_data)
+      self.spill(old_depth, old_data)
+
+  def spill(self, depth, data):
+    if self.directory is None:
+      self.directory = tempfile.mkdtemp(prefix = 'nargyl-levels-')
+    # a new file every time, so one an autosave is reading is never written over
+    path = os.path.join(self.directory, 'level%d-%d' % (depth, self.spills))
+    self.spills += 1
+    with open(path, 'wb') as file:
+      file.write(data)
+    self.spilled[depth] = path
+
+  def read(self, depth):
+    if depth in self.packed:
+      return self.packed[depth]
+    with open(self.spilled[depth], 'rb') as file:
+      return file.read()
+
+  def take(self, depth):
+    # the packed level at this depth, which is no longer stored; None if it never was
+    if depth in self.packed:
+      data = self.packed.pop(depth)
+      self.size -= len(data)
+      return data
+    if depth in self.spilled:
+      data = self.read(depth)
+      path = self.spilled.pop(depth)
+      if self.shared:
+        self.stale.append(path)
+      else:
+        os.remove(path)
+      return data
+    return None
+
+  def sources(self):
+    # every level by depth as (depth, packed, path): the packed bytes if in memory,
+    # else None and the file it was spilled to. Nothing is read from disk here
+    return [(depth, self.packed.get(depth), self.spilled.get(depth))
+            for depth in sorted(list(self.packed.keys()) + list(self.spilled.keys()))]
+
+  def share(self):
+    # the sources, for an autosave to read on its thread; the files stay until release
+    self.shared = True
+    return self.sources()
+
+  def release(self):
+    self.shared = False
+    for path in self.stale:
+      os.remove(path)
+    self.stale = []
+
+  def clear(self):
+    self.packed.clear()
+    self.size = 0
+    self.spilled.clear()
+    self.shared = False
+    self.stale = []
+    if self.directory is not None:
+      shutil.rmtree(self.directory, True)
+      self.directory = None
 
 #############################
 # FUNCTIONS
@@ -407,42 +1116,71 @@ class Item:
 
 def is_blocked(x, y):
   # first, test map tile
-  if map[x][y].blocked:
+  if map.blocked[x][y]:
     return True
 
-  # now check for any blocking objects
-  for object in objects:
-    if object.blocks and object.x == x and object.y == y:
-      return True
+  # now check for any blocking objects on that tile
+  return object_index.blocker_at(x, y) is not None
+
+def add_object(obj):
+  objects.append(obj)
+  object_index.add(obj)
 
-  return False
+def remove_object(obj):
+  objects.remove(obj)
+  object_index.remove(obj)
 
-def create_room(room):
-  global map
-  # go through the tiles in the rectangle and make them passable
-  for x in range(room.x1 + 1, room.x2):
-    for y in range(room.y1 + 1, room.y2):
-      map[x][y].blocked = False
-      map[x][y].block_sight = False
+def create_room(level, room):
+  # make the tiles inside the rectangle passable
+  level.map.set_area(room.x1 + 1, room.x2, room.y1 + 1, room.y2, TILE_FLOOR)
 
-def create_h_tunnel(x1, x2, y):
-  global map
+def create_h_tunnel(level, x1, x2, y):
   # create horizantal hallway
-  for x in range(min(x1, x2), max(x1, x2) + 1):
-    map[x][y].blocked = False
-    map[x][y].block_sight = False
+  level.map.set_area(min(x1, x2), max(x1, x2) + 1, y, y + 1, TILE_FLOOR)
 
-def create_v_tunnel(y1, y2, x):
-  global map
+def create_v_tunnel(level, y1, y2, x):
   # create vertical hallways.
-  for y in range(min(y1, y2), max(y1, y2) + 1):
-    map[x][y].blocked = False
-    map[x][y].block_sight = False
-
-def random_choice_index(chances):  #choose one option from list of chances, returning its index
+  level.map.set_area(x, x + 1, min(y1, y2), max(y1, y2) + 1, TILE_FLOOR)
+
+def level_seed(seed, level):
+  # the generation seed for one dungeon level of a game
+  return (seed * 1000003 + level * 7919) & 0xFFFFFFFF
+
+def turn_seed(seed, turn):
+  # the seed of the AI's stream on one turn of a game
+  return ((seed ^ AI_SEED_SALT) * 1000003 + turn * 7919) & 0xFFFFFFFF
+
+def seed_random_streams(seed, at_turn = 0):
+  # level generation and the AI draw from separate streams, so a random call
+  # in one never changes what the other produces. The AI's stream starts over
+  # every turn, so replaying a game from any turn draws the same numbers
+  global game_seed, turn, ai_rng
+  game_seed = seed
+  turn = at_turn
+  if ai_rng is not None:
+    libtcod.random_delete(ai_rng)
+  ai_rng = libtcod.random_new_from_seed(turn_seed(seed, turn))
+
+def next_turn():
+  seed_random_streams(game_seed, turn + 1)
+
+def start_scheduler():
+  # queue the awake monsters of the level being played
+  global scheduler
+  scheduler = Scheduler(objects, turn * TURN_TICKS)
+
+def wake_monsters():
+  # sleeping monsters the player can see join the queue, in map order so a replay wakes them the same way
+  woken = [obj for obj in object_index.in_range(player.x, player.y, TORCH_RADIUS)
+           if obj.ai and obj.asleep and in_fov(obj.x, obj.y)]
+  woken.sort(key = lambda obj: (obj.y, obj.x))
+  for obj in woken:
+    scheduler.wake(obj, turn * TURN_TICKS)
+
+def random_choice_index(chances, rng):  #choose one option from list of chances, returning its index
 
     #the dice will land on some number between 1 and the sum of the chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+    dice = libtcod.random_get_int(rng, 1, sum(chances))
  
     #go through all chances, keeping the sum so far
     running_sum = 0
@@ -456,24 +1194,21 @@ def random_choice_index(chances):  #choose one option from list of chances, retu
             return choice
         choice += 1
  
-def random_choice(chances_dict):
+def random_choice(chances_dict, rng):
     #choose one option from dictionary of chances, returning its key
     chances = chances_dict.values()
     strings = chances_dict.keys()
  
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, rng)]
  
-def from_dungeon_level(table):
+def from_dungeon_level(table, depth):
   #returns a value that depends on level. the table specifies what value occurs after each level, default is 0.
   for (value, level) in reversed(table):
-    if dungeon_level >= level:
+    if depth >= level:
       return value
   return 0
 
-def get_random_stat():
-  global stat_defense, stat_power
-  global stat_lifesteal, stat_hp
-
+def get_random_stat(rng):
   stat_defense, stat_power = 0, 0
   stat_lifesteal, stat_hp = 0, 0
 
@@ -483,7 +1218,7 @@ def get_random_stat():
   stat_chances['power'] =        25
   stat_chances['lifesteal'] =    5
 
-  choice = random_choice(stat_chances)
+  choice = random_choice(stat_chances, rng)
 
   if choice == 'health':
     stat_hp = 25
@@ -496,79 +1231,79 @@ def get_random_stat():
 
   return choice, stat_power, stat_defense, stat_hp, stat_lifesteal
 
-def place_objects(room):
-  global stat_defense, stat_power
-  global stat_lifesteal, stat_hp
+def place_objects(level, room):
+  rng = level.rng
+  depth = level.dungeon_level
+  player_level = level.player_level
 
   stat_defense, stat_power = 0, 0
   stat_lifesteal, stat_hp = 0, 0
 
   # max number of monsters per room 
-  max_monsters = from_dungeon_level([[2, 1], [4, 4], [6, 6]])
+  max_monsters = from_dungeon_level([[2, 1], [4, 4], [6, 6]], depth)
  
   # chance of each monster type
   monster_chances = {}
   monster_chances['Alien Weakling'] = 80
-  monster_chances['Alien Invader'] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
+  monster_chances['Alien Invader'] = from_dungeon_level([[15, 3], [30, 5], [60, 7]], depth)
 
   # max number of items per room
-  max_items = from_dungeon_level([[1, 1], [2, 4]])
+  max_items = from_dungeon_level([[1, 1], [2, 4]], depth)
 
   # chance of each item
   item_chances = {}
   # scrolls and health pots
   item_chances['health'] = 35
-  item_chances['lightning'] =     from_dungeon_level([[25, 2]])
-  item_chances['confuse'] =       from_dungeon_level([[25, 6]])
-  item_chances['lifesteal'] =     from_dungeon_level([[10, 3]])
+  item_chances['lightning'] =     from_dungeon_level([[25, 2]], depth)
+  item_chances['confuse'] =       from_dungeon_level([[25, 6]], depth)
+  item_chances['lifesteal'] =     from_dungeon_level([[10, 3]], depth)
   # basic items
-  item_chances['sword'] =         from_dungeon_level([[5, 2]])
-  item_chances['bow'] =           from_dungeon_level([[5, 2]])
-  item_chances['armor'] =         from_dungeon_level([[7, 4]])
-  item_chances['shield'] =        from_dungeon_level([[15, 6]])
+  item_chances['sword'] =         from_dungeon_level([[5, 2]], depth)
+  item_chances['bow'] =           from_dungeon_level([[5, 2]], depth)
+  item_chances['armor'] =         from_dungeon_level([[7, 4]], depth)
+  item_chances['shield'] =        from_dungeon_level([[15, 6]], depth)
   # magic items
-  item_chances['magic sword'] =   from_dungeon_level([[5, 5]])  
-  item_chances['magic bow'] =     from_dungeon_level([[5, 7]])
-  item_chances['magic armor'] =   from_dungeon_level([[5, 6]])
-  item_chances['magic shield'] =  from_dungeon_level([[5, 8]])
+  item_chances['magic sword'] =   from_dungeon_level([[5, 5]], depth)  
+  item_chances['magic bow'] =     from_dungeon_level([[5, 7]], depth)
+  item_chances['magic armor'] =   from_dungeon_level([[5, 6]], depth)
+  item_chances['magic shield'] =  from_dungeon_level([[5, 8]], depth)
 
   # choose random number of monsters
-  num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+  num_monsters = libtcod.random_get_int(rng, 0, max_monsters)
 
   # determine coord for monsters randomly
   for i in range(num_monsters):
-    x = libtcod.random_get_int(0, room.x1 + 3, room.x2 - 3)
-    y = libtcod.random_get_int(0, room.y1 + 3, room.y2 - 3)
+    x = libtcod.random_get_int(rng, room.x1 + 3, room.x2 - 3)
+    y = libtcod.random_get_int(rng, room.y1 + 3, room.y2 - 3)
     
     # if the tile is available pick a monster type and put it there
-    if not is_blocked(x, y):
+    if not level.is_blocked(x, y):
   
-      choice = random_choice(monster_chances)
+      choice = random_choice(monster_chances, rng)
 
       if choice == 'Alien Weakling':
-        fighter_component = Fighter(hp = 10 + 10 * player.level, defense = 0 + 0.25 * player.level, 
-                                                   power =  0.5 * player.level + 4, xp = 20 + 5 * player.level, death_function = monster_death)
+        fighter_component = Fighter(hp = 10 + 10 * player_level, defense = 0 + 0.25 * player_level, 
+                                                   power =  0.5 * player_level + 4, xp = 20 + 5 * player_level, death_function = monster_death)
         ai_component = BasicMonster()
         monster = Object(x, y, 'X', 'Alien Weakling', libtcod.desaturated_green, blocks = True, always_visible = False, fighter = fighter_component, ai = ai_component)
 
       elif choice == 'Alien Invader':
-        fighter_component = Fighter(hp = 20 + 15 * player.level, defense = 2 + 0.25 * player.level, 
-                                                   power = 0.5 * player.level + 7, xp = 50 + 10 * player.level, death_function = monster_death)
+        fighter_component = Fighter(hp = 20 + 15 * player_level, defense = 2 + 0.25 * player_level, 
+                                                   power = 0.5 * player_level + 7, xp = 50 + 10 * player_level, death_function = monster_death)
         ai_component = BasicMonster()
         monster = Object(x, y, 'X','Alien Invader', libtcod.darkest_green, blocks = True, always_visible = False, fighter = fighter_component, ai = ai_component)
 
-        
-    objects.append(monster)
+      level.add_object(monster)
 
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = libtcod.random_get_int(rng, 0, max_items)
 
     for i in range(num_items):
-      x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-      y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+      x = libtcod.random_get_int(rng, room.x1 + 1, room.x2 - 1)
+      y = libtcod.random_get_int(rng, room.y1 + 1, room.y2 - 1)
       
-      if not is_blocked(x, y):
+      if not level.is_blocked(x, y):
   
-        choice = random_choice(item_chances)
+        choice = random_choice(item_chances, rng)
 
         if choice == 'health':
           item_component = Item(use_function = cast_heal)
@@ -603,172 +1338,215 @@ def place_objects(room):
           item = Object(x, y, 'A', 'Armor', libtcod.white, equipment = equipment_component)
 
         elif choice == 'magic sword':
-          bonus_stat = get_random_stat()
+          bonus_stat = get_random_stat(rng)
 
           # Swords shouldn't grant defense bonuses
           while bonus_stat[0] == 'defense':
-            bonus_stat = get_random_stat()
+            bonus_stat = get_random_stat(rng)
 
           equipment_component = Equipment(slot = 'right hand', power_bonus = bonus_stat[1] + 3, 
                                                        defense_bonus = bonus_stat[2], max_hp_bonus = bonus_stat[3], life_steal_bonus = bonus_stat[4])
           item = Object(x, y, 't', 'Sword of ' + bonus_stat[0].capitalize(), libtcod.green, equipment = equipment_component) 
         
         elif choice == 'magic bow':
-          bonus_stat = get_random_stat()
+          bonus_stat = get_random_stat(rng)
 
           # Bows shouldn't grant defensive bonuses either
           while bonus_stat[0] == 'defense':
-            bonus_stat = get_random_stat()
+            bonus_stat = get_random_stat(rng)
 
           equipment_component = Equipment(slot = 'right hand', is_ranged = True, power_bonus = bonus_stat[1] + 2, 
                                                        defense_bonus = bonus_stat[2], max_hp_bonus = bonus_stat[3], life_steal_bonus = bonus_stat[4])
           item = Object(x, y, 'D', 'Bow of ' + bonus_stat[0].capitalize(), libtcod.green, equipment = equipment_component)
         
         elif choice == 'magic armor':
-          bonus_stat = get_random_stat()
+          bonus_stat = get_random_stat(rng)
 
           # Armor should not grant lifesteal or power bonuses
           while bonus_stat[0] == 'lifesteal' or bonus_stat[0] == 'power':
-            bonus_stat = get_random_stat()
+            bonus_stat = get_random_stat(rng)
 
           equipment_component = Equipment(slot = 'body', power_bonus = bonus_stat[1], 
                                                        defense_bonus = bonus_stat[2] + 3, max_hp_bonus = bonus_stat[3], life_steal_bonus = bonus_stat[4])
           item = Object(x, y, 'A', 'Armor of ' + bonus_stat[0].capitalize(), libtcod.green, equipment = equipment_component)
         
         elif choice == 'magic shield':
-          bonus_stat = get_random_stat()
+          bonus_stat = get_random_stat(rng)
    
           # Shields should not grant lifesteal or power bonuses either
           while bonus_stat[0] == 'lifesteal' or bonus_stat[0] == 'power':
-            bonus_stat = get_random_stat()
+            bonus_stat = get_random_stat(rng)
 
           equipment_component = Equipment(slot = 'left hand', power_bonus = bonus_stat[1], 
                                                        defense_bonus = bonus_stat[2] + 2, max_hp_bonus = bonus_stat[3], life_steal_bonus = bonus_stat[4])
           item = Object(x, y, ')', 'Shield of ' + bonus_stat[0].capitalize(), libtcod.green, equipment = equipment_component)
 
-        objects.append(item)
-        item.send_to_back()
-
+        level.add_object(item)
+        level.send_to_back(item)
 
-def make_map():
-  global map, objects
-  global stairs
 
-  objects = [player]
+def generate_level(seed, depth, player_level):
+  # build a level without touching the level being played, so it can run on a worker thread
+  # a fresh stream per level, so (seed, depth) always yields the same layout
+  rng = libtcod.random_new_from_seed(level_seed(seed, depth))
+  level = Level(depth, rng, player_level)
 
-  # fill map with 'blocked' tiles
-  map = [[ Tile(True)
-    for y in range(MAP_HEIGHT) ]
-      for x in range(MAP_WIDTH) ]
-
-  if (dungeon_level)%5 != 0:
+  if (depth)%5 != 0:
     rooms = []
+    room_index = RoomIndex()
     num_rooms = 0
 
-    for r in range(MAX_ROOMS + 5 * dungeon_level):
+    for r in range(MAX_ROOMS + 5 * depth):
       # random width/ height
-      w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-      h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+      w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+      h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
       # random position inside boundaries of the map
-      x = libtcod.random_get_int(0,0, MAP_WIDTH - w - 1)
-      y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+      x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+      y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
     
       new_room = Rect(x, y, w, h)
 
-      # run through other rooms to see if there is an intersection.
-      failed = False
-      for other_room in rooms:
-        if new_room.intersect(other_room):
-          failed = True
-          break
+      # check the rooms around it for an intersection.
+      failed = room_index.intersects(new_room)
     
       if not failed:
         # draw the room to the map
-        create_room(new_room)
+        create_room(level, new_room)
            
         (new_x, new_y) = new_room.center()
 
         if num_rooms == 0:
           # Player will start in first room
-          player.x = new_x
-          player.y = new_y
+          level.start_x = new_x
+          level.start_y = new_y
           start = Object(new_x, new_y, '^', 'Start', libtcod.darker_red, blocks = False, always_visible = True)
-          objects.append(start)
+          level.add_object(start)
  
-          if dungeon_level == 5:
+          if depth == 5:
             equipment_component = Equipment(slot = 'right hand', is_ranged = True, power_bonus = 4, defense_bonus =  5, life_steal_bonus = 6)
             item = Object(new_x + 1, new_y, 't', "Master's Bow", libtcod.Color(200, 180, 50), blocks = False, equipment = equipment_component)
-            objects.append(item)
+            level.add_object(item)
      
         else:
 
-          place_objects(new_room)
+          place_objects(level, new_room)
 
           (prev_x, prev_y) = rooms[num_rooms-1].center()
 
-          if libtcod.random_get_int(0,0,1) == 1:
-            create_h_tunnel(prev_x, new_x, prev_y)
-            create_v_tunnel(prev_y, new_y, new_x)
+          if libtcod.random_get_int(rng, 0,1) == 1:
+            create_h_tunnel(level, prev_x, new_x, prev_y)
+            create_v_tunnel(level, prev_y, new_y, new_x)
 
           else:
-            create_v_tunnel(prev_y, new_y, prev_x)
-            create_h_tunnel(prev_x, new_x, new_y)
+            create_v_tunnel(level, prev_y, new_y, prev_x)
+            create_h_tunnel(level, prev_x, new_x, new_y)
 
         rooms.append(new_room)
+        room_index.add(new_room)
         num_rooms += 1
   
-    stairs = Object(new_x, new_y, 'V', 'Stairs', libtcod.white, blocks = False, always_visible = True)
-    objects.append(stairs)
-    stairs.send_to_back()
+    level.stairs = Object(new_x, new_y, 'V', 'Stairs', libtcod.white, blocks = False, always_visible = True)
+    level.add_object(level.stairs)
+    level.send_to_back(level.stairs)
 
   else:
     
-    w = libtcod.random_get_int(0, BOSS_ROOM_MIN_WIDTH, BOSS_ROOM_MAX_WIDTH)
-    h = libtcod.random_get_int(0, BOSS_ROOM_MIN_HEIGHT, BOSS_ROOM_MAX_HEIGHT)
+    w = libtcod.random_get_int(rng, BOSS_ROOM_MIN_WIDTH, BOSS_ROOM_MAX_WIDTH)
+    h = libtcod.random_get_int(rng, BOSS_ROOM_MIN_HEIGHT, BOSS_ROOM_MAX_HEIGHT)
     
     room = Rect(20, 10, w, h)
 
-    create_room(room)
+    create_room(level, room)
 
     (new_x, new_y) = room.center()
-    player.x = new_x
-    player.y = new_y
+    level.start_x = new_x
+    level.start_y = new_y
 
     equipment_component = Equipment(slot = 'right hand', is_ranged = True, power_bonus = 4, defense_bonus =  5, life_steal_bonus = 6)
     item = Object(new_x + 1, new_y, 't', 'Bow of Healing', libtcod.Color(200, 180, 50), blocks = False, equipment = equipment_component)
-    objects.append(item)
+    level.add_object(item)
 
-    x = libtcod.random_get_int(0, room.x1 + 3, room.x2 - 3)
-    y = libtcod.random_get_int(0, room.y1 + 3, room.y2 - 3)
+    x = libtcod.random_get_int(rng, room.x1 + 3, room.x2 - 3)
+    y = libtcod.random_get_int(rng, room.y1 + 3, room.y2 - 3)
     
     # if the tile is available pick a monster type and put it there
-    if not is_blocked(x, y):
+    if not level.is_blocked(x, y):
 
-      fighter_component = Fighter(hp = 80 + 15 * player.level, defense = 5, 
-                                                   power = 6, xp = 100 + 10 * player.level, death_function = boss_death)
+      fighter_component = Fighter(hp = 80 + 15 * player_level, defense = 5, 
+                                                   power = 6, xp = 100 + 10 * player_level, death_function = boss_death)
 
       ai_component = BossMonster()
     
       Boss = Object(x, y, 'X','Alien Champion', libtcod.black, blocks = True, always_visible = False, fighter = fighter_component, ai = ai_component)
-      objects.append(Boss)
+      level.add_object(Boss)
  
 
     for p in range(NUMBER_OF_PILLARS + 1):
-      x = libtcod.random_get_int(0, room.x1 + 1, room.x2)
-      y = libtcod.random_get_int(0, room.y1 + 1, room.y2)
-
-      while x == player.x or x == Boss.x:
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2)
-      while y == player.y or y == Boss.y:
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2)
-
-      map[x][y].blocked = True
-      map[x][y].block_sight = True
-
+      x = libtcod.random_get_int(rng, room.x1 + 1, room.x2)
+      y = libtcod.random_get_int(rng, room.y1 + 1, room.y2)
+
+      while x == level.start_x or x == Boss.x:
+        x = libtcod.random_get_int(rng, room.x1 + 1, room.x2)
+      while y == level.start_y or y == Boss.y:
+        y = libtcod.random_get_int(rng, room.y1 + 1, room.y2)
+
+      level.map.set_tile(x, y, TILE_PILLAR)
+
+  level.rng = None
+  libtcod.random_delete(rng)
+  return level
+
+def install_level(level, x = None, y = None):
+  # make a level the one being played, with the player at its start unless told where
+  global map, objects, object_index, stairs, level_start
+
+  map = level.map
+  objects = level.objects
+  object_index = level.object_index
+  stairs = level.stairs
+  level_start = (level.start_x, level.start_y)
+
+  if x is None:
+    (x, y) = level_start
+  player.x = x
+  player.y = y
+  add_object(player)
+
+  start_scheduler()
+
+def leave_level():
+  # pack the level being played away, so the player can come back to it as it was
+  remove_object(player)
+
+  level = Level(dungeon_level, None, player.level)
+  level.map = map
+  level.objects = objects
+  level.object_index = object_index
+  level.stairs = stairs
+  (level.start_x, level.start_y) = level_start
+  visited_levels.put(dungeon_level, pack_level(level))
 
+def make_map():
+  install_level(generate_level(game_seed, dungeon_level, player.level))
+
+def start_pregeneration():
+  # start building the level below this one in the background, unless it already is
+  global pending_level
+  key = (game_seed, dungeon_level + 1, player.level)
+  if dungeon_level + 1 in visited_levels:
+    return
+  if pending_level is None or pending_level.key != key:
+    pending_level = PendingLevel(*key)
+
+def take_pregenerated_level():
+  # the pre-built level for the current depth, or None if it no longer matches the game
+  global pending_level
+  pending, pending_level = pending_level, None
+  if pending is None or pending.key != (game_seed, dungeon_level, player.level):
+    return None
+  return pending.take()
 
 def player_move_or_attack(dx, dy):
-  global fov_recompute
   global game_state
   global stairs
 
@@ -778,24 +1556,21 @@ def player_move_or_attack(dx, dy):
 
   # Try to find an attackable target there
   target = None
-  for object in objects:
-    if object.x == x and object.y == y:
-      if object.ai is not None:
-        target = object
-        break
+  for object in object_index.at(x, y):
+    if object.ai is not None:
+      target = object
+      break
   
   if target is not None:
     player.fighter.attack(target)
 
   else:
     player.move(dx, dy)
-    fov_recompute = True
 
 
 def handle_keys():
-  global fov_recompute, equipped_list
+  # turn the key pressed into a command for perform_command, or 'exit'
   global key
-  global stairs
   key = libtcod.console_check_for_keypress()
 
   if key.vk == libtcod.KEY_ENTER and key.lalt:
@@ -808,65 +1583,45 @@ def handle_keys():
 
     # Movement Keys
     if key.vk == libtcod.KEY_UP:
-      player_move_or_attack(0, -1)
+      return ('move', 0, -1)
 
     elif key.vk == libtcod.KEY_DOWN:
-      player_move_or_attack(0, 1)
+      return ('move', 0, 1)
 
     elif key.vk == libtcod.KEY_LEFT:
-      player_move_or_attack(-1, 0)
+      return ('move', -1, 0)
 
     elif key.vk == libtcod.KEY_RIGHT:
-      player_move_or_attack(1, 0)
+      return ('move', 1, 0)
   
     elif key.vk == libtcod.KEY_SPACE:
-      
-      flag = False
-      for object in get_all_equipped(player):
-        if object.is_equipped and object.is_ranged:
-          monster = closest_monster(10)
-        
-          if monster is None:
-            message('No monster is close enough to attack!', libtcod.red)
-            flag = True
-            return
-        
-          if line_of_sight(player, monster):
-            player.fighter.attack(monster)
-            flag = True
-            return
-      
-          else:
-            message(monster.name + ' is not in your line of sight!', libtcod.red)
-            flag = True
-            return
-      
-      if not flag:
-        message('You do not have a ranged weapon equipped!',libtcod.red)
+      return ('fire',)
 
     else: 
 
       key_char = chr(key.c)
 
       if key_char == 'v':
-        if stairs.x == player.x and stairs.y == player.y:
-          next_level()
+        return ('descend',)
+
+      if key_char == 'u':
+        return ('ascend',)
 
       if key_char == 'g':
-        for object in objects:
-          if object.x == player.x and object.y == player.y and object.item:
-            object.item.pick_up()
-       
+        return ('pickup',)
 
       if key_char == 'i':
         chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
         if chosen_item is not None:
-          chosen_item.use()
+          return ('use', inventory.index(chosen_item.owner))
 
       if key_char == 'd':
         chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
         if chosen_item is not None:
-          chosen_item.drop()
+          return ('drop', inventory.index(chosen_item.owner))
+
+      if key_char == 'm':
+        message_history()
 
       if key_char == 'c':
         level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
@@ -876,7 +1631,73 @@ def handle_keys():
                                   '\nDefense: ' + str(player.fighter.defense) +
                                     '\nLife Steal: ' + str(player.fighter.life_steal), CHARACTER_SCREEN_WIDTH)
 
-      return 'didnt-take-turn'
+  return None
+
+def perform_command(command):
+  # carry out a player command, the same way whether it came from the keyboard or a script
+  # commands: ('move', dx, dy), ('fire',), ('wait',), ('descend',), ('ascend',), ('pickup',),
+  #           ('use', inventory index), ('drop', inventory index)
+  if game_state != 'playing' or command is None:
+    return 'didnt-take-turn'
+
+  action = command[0]
+
+  if action == 'move':
+    player_move_or_attack(command[1], command[2])
+
+  elif action == 'fire':
+    fire_ranged_weapon()
+
+  elif action == 'wait':
+    pass
+
+  else:
+
+    if action == 'descend':
+      if stairs is not None and stairs.x == player.x and stairs.y == player.y:
+        next_level()
+
+    elif action == 'ascend':
+      if (player.x, player.y) == level_start and dungeon_level - 1 in visited_levels:
+        previous_level()
+
+    elif action == 'pickup':
+      # copy the tile's list, picking up removes objects from it
+      for object in list(object_index.at(player.x, player.y)):
+        if object.item:
+          object.item.pick_up()
+
+    elif action == 'use':
+      inventory[command[1]].item.use()
+
+    elif action == 'drop':
+      inventory[command[1]].item.drop()
+
+    return 'didnt-take-turn'
+
+def fire_ranged_weapon():
+  flag = False
+  for object in get_all_equipped(player):
+    if object.is_equipped and object.is_ranged:
+      monster = closest_monster(10)
+    
+      if monster is None:
+        message('No monster is close enough to attack!', libtcod.red)
+        flag = True
+        return
+    
+      if line_of_sight(player, monster):
+        player.fighter.attack(monster)
+        flag = True
+        return
+  
+      else:
+        message(monster.name + ' is not in your line of sight!', libtcod.red)
+        flag = True
+        return
+  
+  if not flag:
+    message('You do not have a ranged weapon equipped!',libtcod.red)
 
 def next_level():
   global dungeon_level
@@ -886,70 +1707,236 @@ def next_level():
   
   message('After a moment of peace, you venture further into the mine..', libtcod.light_violet)
   
+  leave_level()
   dungeon_level += 1
-  make_map()
+  packed = visited_levels.take(dungeon_level)
+  if packed is not None:
+    level = unpack_level(packed, dungeon_level)
+  else:
+    level = take_pregenerated_level()
+    if level is None:
+      level = generate_level(game_seed, dungeon_level, player.level)
+  install_level(level)
 
   initialize_fov()
+  start_pregeneration()
+
+def previous_level():
+  # climb back to the level above, arriving on its stairs
+  global dungeon_level
+
+  message('You climb back up the mine shaft.', libtcod.light_violet)
+
+  leave_level()
+  dungeon_level -= 1
+  level = unpack_level(visited_levels.take(dungeon_level), dungeon_level)
+  if level.stairs is not None:
+    install_level(level, level.stairs.x, level.stairs.y)
+  else:
+    install_level(level)
+
+  initialize_fov()
+  start_pregeneration()
 
 def initialize_fov():
-  global fov_recompute, fov_map
-  fov_recompute = True
+  global fov_state, fov_map, distance_map, distance_state, visible_tiles, visible_ids, drawn_cells
+  global los_cache, los_cache_key
+  # forget the last fov, so the next render recomputes it
+  fov_state = None
+  visible_tiles = new_plane(map.width, map.height, False)
+  visible_ids = set()
+  # lines of sight were for the old map, whose turn and version a new one can share
+  los_cache = {}
+  los_cache_key = None
+
+  # the distance map reads the old fov map's walkable cells, build it again with the new one
+  if distance_map is not None:
+    libtcod.dijkstra_delete(distance_map)
+  distance_map = None
+  distance_state = None
 
   fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+  transparent, walkable = map.fov_properties()
+  libtcod.map_fill_properties(fov_map, transparent, walkable)
+  # the full rebuild already covers every pending terrain change
+  map.take_dirty()
+
+  if con is not None:
+    libtcod.console_clear(con)
+  drawn_cells = []
+  invalidate_screen()
+
+def invalidate_screen():
+  # something else drew on the screen, like a menu: the next frame redraws all of it
+  global screen_stale, panel_state
+  screen_stale = True
+  panel_state = None
+
+def render_map():
+  # update the map console and the screen under it, but only where something
+  # changed: a frame where the fov, the explored tiles and every shown object
+  # are as they were costs no more than checking that
+  global shown_state, screen_stale, panel_state
+
+  shown = shown_objects()
+  state = [(object.x, object.y, object.char, object.color.r, object.color.g, object.color.b) for object in shown]
+  if not (background_stale or screen_stale) and state == shown_state:
+    return
+  shown_state = state
+  everything = screen_stale
+  screen_stale = False
+
+  if numpy_available:
+    changed = render_map_composited(shown, everything)
+  else:
+    render_map_per_cell(shown)
+    changed = (0, 0, MAP_WIDTH, MAP_HEIGHT)
+
+  if everything:
+    # the whole screen, to clear what was drawn over it; that covers the panel too
+    libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+    panel_state = None
+  elif changed is not None:
+    # only ever the map's part of the screen, the panel below it is drawn on its own
+    (x, y, width, height) = changed
+    width = min(width, MAP_WIDTH - x)
+    height = min(height, MAP_HEIGHT - y)
+    if width > 0 and height > 0:
+      libtcod.console_blit(con, x, y, width, height, 0, x, y)
+
+def render_map_composited(shown, everything):
+  # the map console, terrain and objects, built as arrays; returns the area that changed
+  global compositor, background_stale
+
+  if compositor is None:
+    compositor = Compositor(SCREEN_WIDTH, SCREEN_HEIGHT)
+    background_stale = True
+    everything = True
+  if background_stale:
+    background_stale = False
+    map.explored |= visible_tiles
+    compositor.paint_terrain(map, visible_tiles)
+
+  return compositor.present(con, shown, everything)
+
+def render_map_per_cell(shown):
+  # without NumPy the map is coloured one cell at a time and each object drawn on its own
+  global background_stale, drawn_cells
+
+  if background_stale:
+    background_stale = False
+    render_map_background_per_cell()
+
+  # the objects drawn last frame may have moved since, blank their cells again
+  for (x, y) in drawn_cells:
+    libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+
+  for object in shown:
+    object.draw()
+  drawn_cells = [(object.x, object.y) for object in shown]
+
+def shown_objects():
+  # the objects to draw, in the order they go over each other
+  shown = [object for object in objects if object.shown()]
+  shown.sort(key = Object.layer)
+  return shown
+
+def render_map_background_per_cell():
   for y in range(MAP_HEIGHT):
     for x in range(MAP_WIDTH):
-      libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
-        
-  libtcod.console_clear(con)
+      visible = visible_tiles[x][y]
+      tile_type = TILE_TYPES[map.kinds[x][y]]
+      if not visible:
+        # It's out of the players field of view
+        if map.explored[x][y]:
+          libtcod.console_set_char_background(con, x, y, tile_type.dark, libtcod.BKGND_SET)
 
-def render_all():
-  global fov_map, color_dark_wall
-  global color_light_wall, color_dark_ground
-  global color_light_ground
-  global fov_recompute
-  global level_up_xp
-
-  level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
+      else:
+        # It's in the players field of view
+        libtcod.console_set_char_background(con, x, y, tile_type.light, libtcod.BKGND_SET)
+
+        map.explored[x][y] = True
+
+def player_distance_map():
+  # walking distances from the player to every tile, worked out once a turn and
+  # shared by every monster chasing the player
+  global distance_map, distance_state
+
+  state = (player.x, player.y, map.version)
+  if distance_map is None:
+    distance_map = libtcod.dijkstra_new(fov_map, DIAGONAL_COST)
+  elif state == distance_state:
+    return distance_map
+
+  libtcod.dijkstra_compute(distance_map, player.x, player.y)
+  distance_state = state
+  return distance_map
+
+def update_fov_map():
+  # patch fov_map with only the tiles changed since it was last synced
+  for (x1, x2, y1, y2) in map.take_dirty():
+    for x in range(x1, x2):
+      for y in range(y1, y2):
+        libtcod.map_set_properties(fov_map, x, y, not map.block_sight[x][y], not map.blocked[x][y])
+
+def recompute_fov():
+  # recompute the fov only if the player moved or the terrain changed
+  global fov_state, background_stale
+  update_fov_map()
+
+  state = (player.x, player.y, map.version)
+  if state != fov_state:
+    fov_state = state
+    libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+    snapshot_visible_tiles()
+    background_stale = True
+
+  # monsters move even on turns the player stands still
+  gather_visible_objects()
+
+def snapshot_visible_tiles():
+  # read the whole fov out of libtcod in one call; everything else asks in_fov
+  global visible_tiles
+  fov = libtcod.map_get_fov_array(fov_map)
+  if numpy_available:
+    visible_tiles = fov.reshape(map.height, map.width).T
+  else:
+    visible_tiles = [fov[x::map.width] for x in range(map.width)]
 
+def gather_visible_objects():
+  # the objects standing in view, for drawing
+  global visible_ids
+  visible_ids = set(id(obj) for obj in object_index.in_range(player.x, player.y, TORCH_RADIUS)
+                    if visible_tiles[obj.x][obj.y])
 
-  if fov_recompute:
-    # recompute the fov if needed (player moved or something)
-    fov_recompute = False
-    libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+def in_fov(x, y):
+  # whether the tile was in the player's view when the fov was last computed
+  return 0 <= x < map.width and 0 <= y < map.height and bool(visible_tiles[x][y])
 
-    for y in range(MAP_HEIGHT):
-      for x in range(MAP_WIDTH):
-        visible = libtcod.map_is_in_fov(fov_map, x, y)
-        wall = map[x][y].block_sight
-        if not visible:
-          # It's out of the players field of view
-          if map[x][y].explored:
-            if wall:
-              libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-            else:
-              libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
+def render_all():
+  global level_up_xp
 
-        else:
-          # It's in the players field of view
-          if wall:
-            libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-          else:
-            libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
+  level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
 
-          map[x][y].explored = True
+  recompute_fov()
+  render_map()
+  render_panel()
 
-  for object in objects:
-    if object != player:
-      object.draw()
-  player.draw()
+def render_panel():
+  # the panel is drawn again only when something it shows changed
+  global panel_state
 
-  libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+  names = get_names_under_mouse()
+  state = (game_msgs.added, player.fighter.hp, player.fighter.max_hp, player.fighter.xp, level_up_xp, dungeon_level, names)
+  if state == panel_state:
+    return
+  panel_state = state
 
   libtcod.console_set_default_background(panel, libtcod.black)
   libtcod.console_clear(panel)
 
   y = 1
-  for (line, color) in game_msgs:
+  for (line, color) in game_msgs.lines(MSG_WIDTH, MSG_HEIGHT):
     libtcod.console_set_default_foreground(panel, color)
     libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
     y += 1
@@ -960,18 +1947,55 @@ def render_all():
   libtcod.console_print_ex(panel, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Dungeon level: ' + str(dungeon_level))
 
   libtcod.console_set_default_foreground(panel, libtcod.white)
-  libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+  libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, names)
 
   libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
 
 def message(new_msg, color = libtcod.white):
-  new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
-  
-  for line in new_msg_lines:
-    if len(game_msgs) == MSG_HEIGHT:
-      del game_msgs[0]
+  game_msgs.add(new_msg, color)
+
+def message_history():
+  # every message still kept, newest at the bottom. The arrow and page keys scroll, any other key closes it
+  window = libtcod.console_new(HISTORY_WIDTH, HISTORY_HEIGHT)
+  page = HISTORY_HEIGHT - 1
+  scroll = 0
+
+  while True:
+    lines = game_msgs.lines(HISTORY_WIDTH, page, scroll)
+
+    libtcod.console_clear(window)
+    libtcod.console_set_default_foreground(window, libtcod.white)
+    libtcod.console_print_ex(window, 0, 0, libtcod.BKGND_NONE, libtcod.LEFT, 'Message history')
+    y = HISTORY_HEIGHT - len(lines)
+    for (line, color) in lines:
+      libtcod.console_set_default_foreground(window, color)
+      libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+      y += 1
+
+    x = SCREEN_WIDTH/2 - HISTORY_WIDTH/2
+    y = SCREEN_HEIGHT/2 - HISTORY_HEIGHT/2
+    libtcod.console_blit(window, 0, 0, HISTORY_WIDTH, HISTORY_HEIGHT, 0, x, y, 1.0, 1.0)
+    invalidate_screen()
+    libtcod.console_flush()
 
-    game_msgs.append( (line, color) )
+    key = libtcod.console_wait_for_keypress(True)
+    if key.vk == libtcod.KEY_UP:
+      step = 1
+    elif key.vk == libtcod.KEY_DOWN:
+      step = -1
+    elif key.vk == libtcod.KEY_PAGEUP:
+      step = page
+    elif key.vk == libtcod.KEY_PAGEDOWN:
+      step = -page
+    else:
+      break
+
+    # stop at the oldest message
+    if step > 0 and len(lines) < page:
+      continue
+    scroll = max(0, scroll + step)
+
+  libtcod.console_delete(window)
 
 def msgbox(text, width = 50):
   menu(text, [], width)
@@ -1017,13 +2041,14 @@ def boss_death(monster):
   monster.name = 'remains of ' + monster.name
 
   stairs = Object(monster.x, monster.y, 'V', 'Stairs', libtcod.white, blocks = False, always_visible = True)
-  objects.append(stairs)
+  add_object(stairs)
   stairs.send_to_back()
   monster.send_to_back()
 
     
 
-def check_level_up():
+def check_level_up(choice = None):
+  # choice picks the stat to raise without asking, for headless games
   global level_up_xp
 
   level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
@@ -1040,18 +2065,25 @@ def check_level_up():
     player.color = libtcod.Color(color, color, color)
     message('You can feel yourself growing stronger! You have reached level ' + str(player.level) + '!', libtcod.yellow)
 
-    choice = None
     while choice == None:
       choice = menu('Level up! Choose a stat to raise:\n', ['Constitution (+20 HP)', 'Strength (+1 attack)', 'Toughness (+1 defense)'], LEVEL_SCREEN_WIDTH)
 
     if choice == 0:
-      player.fighter.max_hp += 20
+      player.fighter.base_max_hp += 20
 
     elif choice == 1:
-      player.fighter.power += 1
+      player.fighter.base_power += 1
 
     elif choice == 2:
-      player.fighter.defense += 1
+      player.fighter.base_defense += 1
+
+    player.fighter.invalidate_stats()
+
+    if journal is not None:
+      journal.record(('level_up', choice))
+
+    # monsters on the next level are built for the player's new level
+    start_pregeneration()
   
 
 ##########################
@@ -1062,8 +2094,8 @@ def closest_monster(max_range):
   closest_enemy = None
   closest_dist = max_range + 1
 
-  for object in objects:
-    if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+  for object in object_index.in_range(player.x, player.y, int(max_range)):
+    if object.fighter and not object == player and in_fov(object.x, object.y):
       dist = player.distance_to(object)
       if dist < closest_dist:
         closest_enemy = object
@@ -1071,26 +2103,27 @@ def closest_monster(max_range):
 
   return closest_enemy
 
-def line_of_sight(self, target):
-  x = target.x - self.x
-  y = target.y - self.y
-
-  initial_distance = math.sqrt((x**2) + (y**2))
-
-  deltax = int(round(x/initial_distance))
-  deltay = int(round(y/initial_distance)) 
-  
-  dx, dy = 0, 0
-
-  for t in range(int(round(initial_distance + 1))):
-    if map[self.x + dx][self.y + dy].blocked:
+def line_of_sight(source, target):
+  # whether nothing blocks the sight between two objects. Answers are kept for
+  # the rest of the turn, so asking again about the same tiles costs nothing
+  global los_cache, los_cache_key
+
+  if los_cache_key != (turn, map.version):
+    los_cache = {}
+    los_cache_key = (turn, map.version)
+
+  key = (source.x, source.y, target.x, target.y)
+  clear = los_cache.get(key)
+  if clear is None:
+    clear = los_cache[key] = clear_line(source.x, source.y, target.x, target.y)
+  return clear
+
+def clear_line(x1, y1, x2, y2):
+  # walk the Bresenham line between the tiles; the tile looked from never blocks
+  for (x, y) in libtcod.line_iter(x1, y1, x2, y2):
+    if map.block_sight[x][y] and (x, y) != (x1, y1):
       return False
-
-    dx += deltax
-    dy += deltay
-
   return True
-     
 
 def cast_heal():
   if player.fighter.hp == player.fighter.max_hp:
@@ -1159,7 +2192,9 @@ def get_names_under_mouse():
 
   (x, y) = (mouse.cx, mouse.cy)
 
-  names = [object.name for object in objects if object.x == x and object.y == y and libtcod.map_is_in_fov(fov_map, object.x, object.y)]
+  names = []
+  if in_fov(x, y):
+    names = [object.name for object in object_index.at(x, y)]
 
   names = ', '.join(names)
   return names.capitalize()
@@ -1195,6 +2230,7 @@ def menu(header, options, width):
   y = SCREEN_HEIGHT/2 - height/2
 
   libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+  invalidate_screen()
 
   # present the root console to player and wait for them to take action
   libtcod.console_flush()
@@ -1221,23 +2257,32 @@ def inventory_menu(header):
   if index is None or len(inventory) == 0: return None
   return inventory[index].item
 
-def new_game():
-  global player, inventory, game_msgs, game_state, dungeon_level
+def new_game(seed = None):
+  global player, inventory, game_msgs, game_state, dungeon_level, pending_level
 
-  fighter_component = Fighter(hp = 100, defense = 2, power = 5, xp = 0, death_function = player_death)
-  player = Object(0, 0, 'O', 'player', libtcod.Color(0, 0, 0), blocks=True, fighter = fighter_component)
+  if seed is None:
+    seed = libtcod.random_get_int(0, 0, 0x7FFFFFFF)
+  # saves hold the seed in 32 bits; the streams only ever use those, so any int gives the same game
+  seed &= 0xFFFFFFFF
+  seed_random_streams(seed)
 
-  player.level = 1
+  fighter_component = Fighter(hp = 100, defense = 2, power = 5, xp = 0, death_function = player_death)
+  player = Object(0, 0, 'O', 'player', libtcod.Color(0, 0, 0), blocks=True, fighter = fighter_component, level = 1)
 
   dungeon_level = 1
 
+  # an autosave of the last game may still be reading its levels
+  finish_autosave()
+  visited_levels.clear()
   make_map()
   initialize_fov()
+  pending_level = None
+  start_pregeneration()
   
   game_state = 'playing'
   inventory= []
 
-  game_msgs = []
+  game_msgs = MessageLog()
 
   message("Welcome Stranger! Prepare to battle with the Aliens of Nar'Gyl!", libtcod.red)
 
@@ -1245,9 +2290,14 @@ def play_game():
   global key, mouse
 
   player_action = None
+  turns_since_save = 0
 
   mouse = libtcod.Mouse()
   key = libtcod.Key()
+  # the main menu was on the screen
+  invalidate_screen()
+
+  open_journal()
 
   while not libtcod.console_is_window_closed():
 
@@ -1258,46 +2308,581 @@ def play_game():
 
     check_level_up()
 
-    for object in objects:
-      object.clear()
-  
-    player_action = handle_keys()
-    if player_action == 'exit':
+    command = handle_keys()
+    if command == 'exit':
       save_game()
+      close_journal()
       break
 
-    if game_state == 'playing' and player_action != 'didnt-take-turn':
-      for object in objects:
-        if object.ai:
-          object.ai.take_turn()
+    player_action = play_turn(command)
+
+    if player_action != 'didnt-take-turn' and game_state == 'playing':
+      turns_since_save += 1
+      if turns_since_save >= AUTOSAVE_TURNS and autosave():
+        turns_since_save = 0
+
+def play_turn(command):
+  # the player's command, then every monster's turn if the player used theirs
+  if journal is not None and command is not None:
+    journal.record(command)
+
+  player_action = perform_command(command)
+
+  if game_state == 'playing' and player_action != 'didnt-take-turn':
+    next_turn()
+    wake_monsters()
+    scheduler.run_until(turn * TURN_TICKS)
+
+  return player_action
+
+def step(command, level_up_choice = 0):
+  # one headless turn: no window is needed and nothing is drawn
+  recompute_fov()
+  player_action = play_turn(command)
+  check_level_up(level_up_choice)
+  return player_action
+
+###########################
+# SAVE FORMAT              #
+###########################
+
+# Little-endian, all offsets implicit:
+#   header, string table, the tile kinds (a byte per tile) and the bit-packed explored plane,
+#   entity records, objects and inventory as entity numbers, message records,
+#   then every level left behind as a depth and a zlib-compressed level pack.
+# A level pack is the same layout for one level on its own: header, strings,
+# tiles, entity records and objects.
+# Every string (names, slots, messages, game state) lives once in the string table
+# and records refer to it by number. Components are stored by kind, as a number
+# into the tables below, so new entries must only ever be appended.
+
+SAVE_HEADER = struct.Struct('<4sHIIHHHiiIIIIIHHhhH')
+LEVEL_HEADER = struct.Struct('<HHHhhiIII')
+LEVEL_RECORD = struct.Struct('<HI')
+ENTITY_RECORD = struct.Struct('<hhB3BHH5dBBBHhhBH4dIIH')
+MESSAGE_RECORD = struct.Struct('<3BH')
+STRING_LENGTH = struct.Struct('<H')
+
+DEATH_FUNCTIONS = [None, player_death, monster_death, boss_death, projectile_death]
+USE_FUNCTIONS = [None, cast_heal, cast_confuse, cast_lightning, cast_lifesteal]
+AI_KINDS = [None, BasicMonster, BossMonster, ConfusedMonster, Projectile]
+
+# flags of an entity record
+ENTITY_BLOCKS = 1
+ENTITY_ALWAYS_VISIBLE = 2
+ENTITY_FIGHTER = 4
+ENTITY_AI = 8
+ENTITY_ITEM = 16
+ENTITY_EQUIPMENT = 32
+ENTITY_COLLECTABLE = 64
+ENTITY_EQUIPPED = 128
+ENTITY_RANGED = 256
+ENTITY_ASLEEP = 512
+
+def encode_string(text):
+  if isinstance(text, bytes):
+    return text
+  return text.encode('utf-8')
+
+def decode_string(raw):
+  if str is bytes:  # Python 2 strings are already bytes
+    return raw
+  return raw.decode('utf-8')
+
+def exact_number(value):
+  # doubles come back as floats; give whole numbers back their int type
+  if value == int(value):
+    return int(value)
+  return value
+
+class StringTable:
+  # numbers each distinct string once while a save is written
+  def __init__(self):
+    self.strings = []
+    self.numbers = {}
+
+  def number(self, text):
+    number = self.numbers.get(text)
+    if number is None:
+      number = self.numbers[text] = len(self.strings)
+      self.strings.append(text)
+    return number
+
+  def pack(self):
+    chunks = []
+    for text in self.strings:
+      raw = encode_string(text)
+      chunks.append(STRING_LENGTH.pack(len(raw)))
+      chunks.append(raw)
+    return b''.join(chunks)
+
+def unpack_strings(data, offset, count):
+  strings = []
+  for i in range(count):
+    (length,) = STRING_LENGTH.unpack_from(data, offset)
+    offset += STRING_LENGTH.size
+    strings.append(decode_string(data[offset:offset + length]))
+    offset += length
+  return strings, offset
+
+def packed_plane_size(width, height):
+  return (width * height + 7) // 8
+
+def pack_plane(plane, width, height):
+  # one bit per tile, x-major, most significant bit first
+  if numpy_available:
+    return numpy.packbits(numpy.ravel(plane)).tobytes()
+  packed = bytearray(packed_plane_size(width, height))
+  i = 0
+  for x in range(width):
+    column = plane[x]
+    for y in range(height):
+      if column[y]:
+        packed[i >> 3] |= 0x80 >> (i & 7)
+      i += 1
+  return bytes(packed)
+
+def unpack_plane(data, offset, width, height):
+  size = packed_plane_size(width, height)
+  if numpy_available:
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8, count=size, offset=offset))
+    return bits[:width * height].reshape(width, height).astype(bool)
+  packed = bytearray(data[offset:offset + size])
+  plane = []
+  i = 0
+  for x in range(width):
+    column = []
+    for y in range(height):
+      column.append(bool(packed[i >> 3] & (0x80 >> (i & 7))))
+      i += 1
+    plane.append(column)
+  return plane
+
+def pack_kinds(kinds, width, height):
+  # one byte per tile, x-major
+  if numpy_available:
+    return numpy.ascontiguousarray(kinds, dtype=numpy.uint8).tobytes()
+  return bytes(bytearray(kind for column in kinds for kind in column))
+
+def unpack_kinds(data, offset, width, height):
+  if numpy_available:
+    return numpy.frombuffer(data, dtype=numpy.uint8, count=width * height, offset=offset).reshape(width, height).copy()
+  raw = bytearray(data[offset:offset + width * height])
+  return [list(raw[x * height:(x + 1) * height]) for x in range(width)]
+
+def pack_tiles(tile_map):
+  return (pack_kinds(tile_map.kinds, tile_map.width, tile_map.height) +
+          pack_plane(tile_map.explored, tile_map.width, tile_map.height))
+
+def unpack_tiles(data, offset, width, height):
+  tile_map = TileMap(width, height)
+  tile_map.set_kinds(unpack_kinds(data, offset, width, height))
+  offset += width * height
+  tile_map.explored = unpack_plane(data, offset, width, height)
+  return tile_map, offset + packed_plane_size(width, height)
+
+def pack_entity(obj, strings):
+  flags = 0
+  if obj.blocks: flags |= ENTITY_BLOCKS
+  if obj.always_visible: flags |= ENTITY_ALWAYS_VISIBLE
+  if obj.asleep: flags |= ENTITY_ASLEEP
+
+  fighter = obj.fighter
+  stats = (0, 0, 0, 0, 0)
+  death = 0
+  if fighter:
+    flags |= ENTITY_FIGHTER
+    stats = (fighter.base_max_hp, fighter.hp, fighter.base_defense, fighter.base_power, fighter.xp)
+    death = DEATH_FUNCTIONS.index(fighter.death_function)
+
+  ai = obj.ai
+  ai_kind, old_kind, turns, target_x, target_y = 0, 0, 0, 0, 0
+  if ai:
+    flags |= ENTITY_AI
+    ai_kind = AI_KINDS.index(ai.__class__)
+    if isinstance(ai, ConfusedMonster):
+      # a monster confused twice still wakes up with its own ai
+      old_ai = ai.old_ai
+      while isinstance(old_ai, ConfusedMonster):
+        old_ai = old_ai.old_ai
+      old_kind = AI_KINDS.index(old_ai.__class__)
+      turns = ai.num_turns
+    elif isinstance(ai, Projectile):
+      target_x, target_y = ai.target_x, ai.target_y
+
+  use = 0
+  if obj.item:
+    flags |= ENTITY_ITEM
+    if obj.item.collectable: flags |= ENTITY_COLLECTABLE
+    use = USE_FUNCTIONS.index(obj.item.use_function)
+
+  equipment = obj.equipment
+  slot = 0
+  bonuses = (0, 0, 0, 0)
+  if equipment:
+    flags |= ENTITY_EQUIPMENT
+    if equipment.is_equipped: flags |= ENTITY_EQUIPPED
+    if equipment.is_ranged: flags |= ENTITY_RANGED
+    slot = strings.number(equipment.slot)
+    bonuses = (equipment.power_bonus, equipment.defense_bonus, equipment.max_hp_bonus, equipment.life_steal_bonus)
+
+  return ENTITY_RECORD.pack(obj.x, obj.y, ord(obj.char), obj.color.r, obj.color.g, obj.color.b,
+                            flags, strings.number(obj.name), *(stats + (death, ai_kind, old_kind, turns,
+                            target_x, target_y, use, slot) + bonuses + (obj.ready_at, obj.serial, obj.speed)))
+
+def unpack_entity(data, offset, strings):
+  (x, y, char, r, g, b, flags, name, base_max_hp, hp, defense, power, xp, death, ai_kind, old_kind, turns,
+   target_x, target_y, use, slot, power_bonus, defense_bonus, max_hp_bonus, life_steal_bonus,
+   ready_at, serial, speed) = ENTITY_RECORD.unpack_from(data, offset)
+
+  fighter = None
+  if flags & ENTITY_FIGHTER:
+    fighter = Fighter(hp = exact_number(base_max_hp), defense = exact_number(defense), power = exact_number(power),
+                      xp = exact_number(xp), death_function = DEATH_FUNCTIONS[death])
+    fighter.hp = exact_number(hp)
+
+  ai = None
+  if flags & ENTITY_AI:
+    if AI_KINDS[ai_kind] is ConfusedMonster:
+      ai = ConfusedMonster(AI_KINDS[old_kind](), turns)
+    elif AI_KINDS[ai_kind] is Projectile:
+      ai = Projectile(target_x, target_y)
+    else:
+      ai = AI_KINDS[ai_kind]()
+
+  item = None
+  equipment = None
+  if flags & ENTITY_EQUIPMENT:
+    equipment = Equipment(strings[slot], is_ranged = bool(flags & ENTITY_RANGED), power_bonus = exact_number(power_bonus),
+                          defense_bonus = exact_number(defense_bonus), max_hp_bonus = exact_number(max_hp_bonus),
+                          life_steal_bonus = exact_number(life_steal_bonus))
+    equipment.is_equipped = bool(flags & ENTITY_EQUIPPED)
+  elif flags & ENTITY_ITEM:
+    item = Item(collectable = bool(flags & ENTITY_COLLECTABLE), use_function = USE_FUNCTIONS[use])
+
+  obj = Object(x, y, chr(char), strings[name], libtcod.Color(r, g, b), blocks = bool(flags & ENTITY_BLOCKS),
+               always_visible = bool(flags & ENTITY_ALWAYS_VISIBLE), fighter = fighter, ai = ai, item = item, equipment = equipment,
+               speed = speed)
+  obj.asleep = bool(flags & ENTITY_ASLEEP)
+  obj.ready_at = ready_at
+  obj.serial = serial
+  if ai and isinstance(ai, ConfusedMonster):
+    ai.old_ai.owner = obj
+  return obj
+
+class EntityTable:
+  # gives every distinct object one record, so an object listed twice is still one object after loading
+  def __init__(self, strings):
+    self.strings = strings
+    self.records = []
+    self.numbers = {}
+
+  def number(self, obj):
+    number = self.numbers.get(id(obj))
+    if number is None:
+      number = self.numbers[id(obj)] = len(self.records)
+      self.records.append(pack_entity(obj, self.strings))
+    return number
+
+  def numbers_of(self, objs):
+    numbers = [self.number(obj) for obj in objs]
+    return struct.pack('<%dI' % len(numbers), *numbers)
+
+def unpack_entities(data, offset, count, strings):
+  entities = []
+  for i in range(count):
+    entities.append(unpack_entity(data, offset, strings))
+    offset += ENTITY_RECORD.size
+  return entities, offset
+
+def unpack_numbers(data, offset, count, entities):
+  numbers = struct.unpack_from('<%dI' % count, data, offset)
+  return [entities[n] for n in numbers], offset + 4 * count
+
+def serialize_game():
+  # the whole game state as bytes
+  levels = visited_levels.sources()
+  return serialize_head(len(levels)) + pack_level_records(levels)
+
+def serialize_head(num_levels):
+  # the game state as bytes, but for the records of the levels left behind, which follow it in a save
+  strings = StringTable()
+  entities = EntityTable(strings)
+
+  object_numbers = entities.numbers_of(objects)
+  inventory_numbers = entities.numbers_of(inventory)
+  player_index = objects.index(player)
+  stairs_index = objects.index(stairs) if stairs in objects else -1
+
+  messages = b''.join(MESSAGE_RECORD.pack(color.r, color.g, color.b, strings.number(text)) for (text, color) in game_msgs)
+
+  header = SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, game_seed, turn, dungeon_level, player.level, strings.number(game_state),
+                            player_index, stairs_index, len(entities.records), len(objects), len(inventory), len(game_msgs),
+                            len(strings.strings), map.width, map.height, level_start[0], level_start[1],
+                            num_levels)
+
+  return b''.join([header, strings.pack(), pack_tiles(map), b''.join(entities.records),
+                   object_numbers, inventory_numbers, messages])
+
+def pack_level_records(levels):
+  # the records of the levels left behind, from LevelStore.sources; spilled ones are read back here
+  records = []
+  for (depth, packed, path) in levels:
+    if packed is None:
+      with open(path, 'rb') as file:
+        packed = file.read()
+    records.append(LEVEL_RECORD.pack(depth, len(packed)) + packed)
+  return b''.join(records)
+
+def deserialize_game(data):
+  # returns the size of the save's head, the part before the level records
+  global map, objects, object_index, player, inventory, game_msgs, game_state, stairs, dungeon_level, level_start
+
+  (magic, version, seed, saved_turn, depth, player_level, state, player_index, stairs_index, num_entities, num_objects,
+   num_inventory, num_messages, num_strings, width, height, start_x, start_y, num_levels) = SAVE_HEADER.unpack_from(data, 0)
+  if magic != SAVE_MAGIC or version != SAVE_VERSION:
+    raise ValueError('Not a version %d save file.' % SAVE_VERSION)
+
+  offset = SAVE_HEADER.size
+  strings, offset = unpack_strings(data, offset, num_strings)
+  map, offset = unpack_tiles(data, offset, width, height)
+  entities, offset = unpack_entities(data, offset, num_entities, strings)
+  objects, offset = unpack_numbers(data, offset, num_objects, entities)
+  inventory, offset = unpack_numbers(data, offset, num_inventory, entities)
+
+  game_msgs = MessageLog()
+  for i in range(num_messages):
+    (r, g, b, text) = MESSAGE_RECORD.unpack_from(data, offset)
+    game_msgs.add(strings[text], libtcod.Color(r, g, b))
+    offset += MESSAGE_RECORD.size
+
+  head_size = offset
+  visited_levels.clear()
+  for i in range(num_levels):
+    (level_depth, size) = LEVEL_RECORD.unpack_from(data, offset)
+    offset += LEVEL_RECORD.size
+    visited_levels.put(level_depth, data[offset:offset + size])
+    offset += size
+
+  player = objects[player_index]
+  player.level = player_level
+  stairs = objects[stairs_index] if stairs_index >= 0 else None
+  dungeon_level = depth
+  game_state = strings[state]
+  level_start = (start_x, start_y)
+  seed_random_streams(seed, saved_turn)
+  object_index = SpatialIndex(objects)
+  start_scheduler()
+  return head_size
+
+def pack_level(level):
+  # a level on its own, compressed, for keeping it while the player is elsewhere
+  strings = StringTable()
+  entities = EntityTable(strings)
+
+  object_numbers = entities.numbers_of(level.objects)
+  stairs_index = level.objects.index(level.stairs) if level.stairs in level.objects else -1
+
+  header = LEVEL_HEADER.pack(level.map.width, level.map.height, level.player_level, level.start_x, level.start_y,
+                             stairs_index, len(entities.records), len(level.objects), len(strings.strings))
+
+  return zlib.compress(b''.join([header, strings.pack(), pack_tiles(level.map), b''.join(entities.records), object_numbers]))
+
+def unpack_level(packed, depth):
+  data = zlib.decompress(packed)
+  (width, height, player_level, start_x, start_y, stairs_index, num_entities, num_objects,
+   num_strings) = LEVEL_HEADER.unpack_from(data, 0)
+
+  level = Level(depth, None, player_level)
+  offset = LEVEL_HEADER.size
+  strings, offset = unpack_strings(data, offset, num_strings)
+  level.map, offset = unpack_tiles(data, offset, width, height)
+  entities, offset = unpack_entities(data, offset, num_entities, strings)
+  level.objects, offset = unpack_numbers(data, offset, num_objects, entities)
+
+  level.object_index = SpatialIndex(level.objects)
+  level.stairs = level.objects[stairs_index] if stairs_index >= 0 else None
+  level.start_x = start_x
+  level.start_y = start_y
+  return level
+
+###########################
+# TURN JOURNAL             #
+###########################
+
+# The journal is a run of fixed-size records appended as the game is played:
+# every command, every level-up choice, and a snapshot record each time a full
+# save is taken. Loading a save replays the commands journaled after its
+# snapshot record, so only a few bytes are written per turn. Each record holds
+# the turn it was played on; the AI's stream is reseeded from it every turn.
+
+JOURNAL_RECORD = struct.Struct('<BIbb')
+JOURNAL_ACTIONS = ['snapshot', 'move', 'fire', 'wait', 'descend', 'pickup', 'use', 'drop', 'level_up', 'ascend']
+
+def snapshot_checksum(head):
+  # of a save's head, without the levels left behind: an autosave only reads those
+  # on its own thread, and the head, which holds the turn, already tells snapshots apart
+  return zlib.crc32(head) & 0xFFFFFFFF
+
+def pack_journal_record(command, turn):
+  args = tuple(command[1:]) + (0, 0)
+  return JOURNAL_RECORD.pack(JOURNAL_ACTIONS.index(command[0]), turn, args[0], args[1])
+
+def unpack_journal_record(data, offset):
+  (action, turn, a, b) = JOURNAL_RECORD.unpack_from(data, offset)
+  action = JOURNAL_ACTIONS[action]
+  if action == 'move':
+    return (action, a, b), turn
+  if action in ('use', 'drop', 'level_up'):
+    return (action, a), turn
+  return (action,), turn
+
+class Journal:
+  # appends to the journal file, and cuts it back to the last snapshot once that is safely saved
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, 'ab')
+    self.snapshot_record = None
+    self.records = []
+
+  def append(self, record):
+    # flushed at once, so it survives the game crashing
+    self.file.write(record)
+    self.file.flush()
+
+  def record(self, command):
+    record = pack_journal_record(command, turn)
+    self.append(record)
+    self.records.append(record)
+
+  def snapshot(self, head):
+    # mark where a full save of the game was taken
+    self.snapshot_record = JOURNAL_RECORD.pack(0, snapshot_checksum(head), 0, 0)
+    self.append(self.snapshot_record)
+    self.records = []
+
+  def compact(self):
+    # the last snapshot is on disk now, nothing before it is needed
+    self.file.close()
+    write_save(b''.join([self.snapshot_record] + self.records), self.path)
+    self.file = open(self.path, 'ab')
+
+  def close(self):
+    self.file.close()
+
+def read_journal(path, head):
+  # the commands journaled after the snapshot with this head, with the turn each was played on
+  try:
+    with open(path, 'rb') as file:
+      data = file.read()
+  except IOError:
+    return []
+
+  checksum = snapshot_checksum(head)
+  commands = None
+  # a record torn by a crash is cut off at the end
+  for offset in range(0, len(data) - JOURNAL_RECORD.size + 1, JOURNAL_RECORD.size):
+    command, record_turn = unpack_journal_record(data, offset)
+    if command[0] == 'snapshot':
+      # later snapshots that never made it to disk are just passed by
+      if record_turn == checksum:
+        commands = []
+    elif commands is not None:
+      commands.append((command, record_turn))
+  return commands or []
+
+def replay_journal(commands):
+  # play the journaled commands again, stopping if the journal stops matching the game
+  for (command, played_turn) in commands:
+    if played_turn != turn:
+      break
+    if command[0] == 'level_up':
+      check_level_up(command[1])
+    else:
+      recompute_fov()
+      play_turn(command)
+
+def open_journal():
+  # journal every command from now on, starting from a full save of the game as it is
+  global journal
+  close_journal()
+  journal = Journal(JOURNAL_FILE)
+  save_game()
+
+def close_journal():
+  global journal
+  if journal is not None:
+    journal.close()
+    journal = None
+
+def replace_file(source, destination):
+  if hasattr(os, 'replace'):
+    os.replace(source, destination)
+  else:
+    # Python 2 can only rename over an existing file on POSIX
+    if os.name == 'nt' and os.path.exists(destination):
+      os.remove(destination)
+    os.rename(source, destination)
+
+def write_save(data, path):
+  # write beside the old save and only then swap it in, a crash mid-write keeps the old save
+  temp_path = path + '.tmp'
+  with open(temp_path, 'wb') as file:
+    file.write(data)
+    file.flush()
+    os.fsync(file.fileno())
+  replace_file(temp_path, path)
+
+def finish_autosave():
+  # wait for an autosave still being written, it must not land after a newer save
+  global pending_save
+  if pending_save is not None:
+    error = pending_save.finish()
+    pending_save = None
+    visited_levels.release()
+    if error:
+      message('Autosave failed: ' + str(error), libtcod.red)
+    elif journal is not None:
+      journal.compact()
+
+def autosave():
+  # snapshot the game now and write it out in the background, False if the last one is still being written
+  global pending_save
+  if pending_save is not None:
+    if not pending_save.done():
+      return False
+    finish_autosave()
+  # the levels left behind go by reference, spilled ones are read from disk by the writer
+  levels = visited_levels.share()
+  head = serialize_head(len(levels))
+  pending_save = PendingSave(head, levels, SAVE_FILE)
+  if journal is not None:
+    journal.snapshot(head)
+  return True
 
 def save_game():
-  file = shelve.open('savegame', 'n')
-  file['map'] = map
-  file['objects'] = objects
-  file['player_index'] = objects.index(player)
-  file['stairs_index'] = objects.index(stairs)
-  file['dungeon_level'] = dungeon_level
-  file['inventory'] = inventory
-  file['game_msgs'] = game_msgs
-  file['game_state'] = game_state
-  file.close()
+  finish_autosave()
+  levels = visited_levels.sources()
+  head = serialize_head(len(levels))
+  write_save(head + pack_level_records(levels), SAVE_FILE)
+  if journal is not None:
+    journal.snapshot(head)
+    journal.compact()
 
 def load_game():
-  global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
-
-  file = shelve.open('savegame', 'r')
-  map = file['map']
-  objects = file['objects']
-  player = objects[file['player_index']]
-  stairs = objects[file['stairs_index']]
-  dungeon_level = file['dungeon_level']
-  inventory = file['inventory']
-  game_msgs = file['game_msgs']
-  game_state = file['game_state']
-  file.close()
+  global pending_level
+
+  finish_autosave()
+  close_journal()
+  with open(SAVE_FILE, 'rb') as file:
+    data = file.read()
+  head_size = deserialize_game(data)
 
   initialize_fov()
+  # catch up with what was played after the save was taken
+  replay_journal(read_journal(JOURNAL_FILE, data[:head_size]))
+  pending_level = None
+  start_pregeneration()
   
 def main_menu():
 
@@ -1319,8 +2904,13 @@ def main_menu():
     if choice == 1:
       try:
         load_game()
-      except:
+      except IOError:
         msgbox('\nNo Saved game to load.\n', 24)
+      except (ValueError, struct.error, zlib.error):
+        # from another version of the game, or cut short
+        msgbox('\nThe saved game could not be read.\n', 24)
+      else:
+        play_game()
 
     elif choice == 2:
       break
@@ -1329,13 +2919,45 @@ def main_menu():
 # System Initialization
 ###################################
 
-libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "Mines of Nar'Gyl", False)
-libtcod.sys_set_fps(LIMIT_FPS)
-
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-main_menu()
+# both stay None in a headless game: import this module, call new_game()
+# and then step() with commands, without ever opening a window
+con = None
+panel = None
+
+# the autosave still being written, if any
+pending_save = None
+# the journal commands are appended to, once play_game opens it
+journal = None
+ai_rng = None
+distance_map = None
+los_cache_key = None
+# the map console's frame builder, made on the first render with NumPy
+compositor = None
+# where objects were drawn last frame, when drawing them one by one
+drawn_cells = []
+# what the screen showed last frame, see render_map and render_panel
+screen_stale = True
+shown_state = None
+panel_state = None
+
+# the levels the player has been to, other than the current one
+visited_levels = LevelStore()
+atexit.register(visited_levels.clear)
+
+def init_console():
+  global con, panel
+
+  # the font sits beside this file, whatever the working directory, the benchmark runs elsewhere
+  font = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arial10x10.png')
+  libtcod.console_set_custom_font(font, libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+  libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "Mines of Nar'Gyl", False)
+  libtcod.sys_set_fps(LIMIT_FPS)
+
+  con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+  panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+if __name__ == '__main__':
+  init_console()
+  main_menu()
   
 
@@ -1577,6 +1577,59 @@ def map_get_width(map):
 def map_get_height(map):
     return _lib.TCOD_map_get_height(map)
 
+# mirrors map_t in libtcod_int.h. Each cell_t packs its three bool
+# bitfields into one byte: transparent, walkable and fov, lowest bit first.
+class _CMap(Structure):
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('nbcells', c_int),
+              ('cells', POINTER(c_uint8)),
+              ]
+
+_MAP_CELL_TRANSPARENT = 1
+_MAP_CELL_WALKABLE = 2
+_MAP_CELL_FOV = 4
+
+def _map_cells(m):
+    cmap = cast(c_void_p(m), POINTER(_CMap)).contents
+    return cmap.cells, cmap.nbcells
+
+# fast map filling. transparent and walkable hold one entry per cell in
+# row-major order (x + y * width): NumPy arrays, byte strings or sequences.
+# Every cell's fov flag is cleared.
+def map_fill_properties(m, transparent, walkable):
+    cells, nbcells = _map_cells(m)
+    if (numpy_available and isinstance(transparent, numpy.ndarray) and
+        isinstance(walkable, numpy.ndarray)):
+        transparent = numpy.ravel(transparent)
+        walkable = numpy.ravel(walkable)
+        if transparent.size != nbcells or walkable.size != nbcells:
+            raise TypeError('Transparent and walkable must have one value per map cell.')
+        packed = numpy.where(transparent != 0, _MAP_CELL_TRANSPARENT, 0)
+        packed |= numpy.where(walkable != 0, _MAP_CELL_WALKABLE, 0)
+        packed = numpy.ascontiguousarray(packed, dtype=numpy.uint8)
+        memmove(cells, packed.ctypes.data, nbcells)
+    else:
+        if isinstance(transparent, (bytes, bytearray)):
+            transparent = bytearray(transparent)
+        if isinstance(walkable, (bytes, bytearray)):
+            walkable = bytearray(walkable)
+        if len(transparent) != nbcells or len(walkable) != nbcells:
+            raise TypeError('Transparent and walkable must have one value per map cell.')
+        packed = bytearray(nbcells)
+        for i in range(nbcells):
+            packed[i] = ((_MAP_CELL_TRANSPARENT if transparent[i] else 0) |
+                         (_MAP_CELL_WALKABLE if walkable[i] else 0))
+        memmove(cells, (c_uint8 * nbcells).from_buffer(packed), nbcells)
+
+# fast fov reading, one entry per cell in row-major order (x + y * width)
+def map_get_fov_array(m):
+    cells, nbcells = _map_cells(m)
+    raw = string_at(cells, nbcells)
+    if numpy_available:
+        return (numpy.frombuffer(raw, dtype=numpy.uint8) & _MAP_CELL_FOV) != 0
+    return [(c & _MAP_CELL_FOV) != 0 for c in bytearray(raw)]
+
 ############################
 # pathfinding module
 ############################
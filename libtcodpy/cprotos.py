@@ -657,7 +657,7 @@ def setup_protos(lib):
     lib.TCOD_random_restore.argtypes=[c_void_p , c_void_p ]
 
     lib.TCOD_random_new_from_seed.restype=c_void_p
-    lib.TCOD_random_new_from_seed.argtypes=[c_int , c_int ]
+    lib.TCOD_random_new_from_seed.argtypes=[c_int , c_uint ]
 
     lib.TCOD_random_delete.restype=c_void
     lib.TCOD_random_delete.argtypes=[c_void_p ]
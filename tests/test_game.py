@@ -0,0 +1,44 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import game
+
+class PlacementTest(unittest.TestCase):
+  def test_generated_objects_are_distinct(self):
+    for seed in range(1, 9):
+      for depth in range(1, 13):
+        level = game.generate_level(seed, depth, 1)
+        self.assertEqual(len(set(map(id, level.objects))), len(level.objects), (seed, depth))
+        indexed = sum(len(cell) for cell in level.object_index.cells.values())
+        self.assertEqual(indexed, len(level.objects), (seed, depth))
+
+  def test_moving_leaves_no_blocker_behind(self):
+    game.new_game(5)
+    game.pending_level.take()
+    for monster in [obj for obj in game.objects if obj.ai]:
+      (x, y) = (monster.x, monster.y)
+      for (dx, dy) in game.NEIGHBOURS:
+        if not game.is_blocked(x + dx, y + dy):
+          monster.move(dx, dy)
+          break
+      else:
+        continue
+      self.assertNotIn(monster, game.object_index.at(x, y))
+      self.assertIsNone(game.object_index.blocker_at(x, y))
+      self.assertIn(monster, game.object_index.at(monster.x, monster.y))
+
+class SaveTest(unittest.TestCase):
+  def test_any_seed_saves(self):
+    for seed in (-1, 2 ** 40 + 7):
+      game.new_game(seed)
+      game.pending_level.take()
+      data = game.serialize_game()
+      game.deserialize_game(data)
+      self.assertEqual(game.game_seed, seed & 0xFFFFFFFF)
+      self.assertEqual(game.serialize_game(), data)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+from ctypes import CFUNCTYPE, c_int, c_uint, c_void_p, cast
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libtcodpy as libtcod
+from libtcodpy.cprotos import setup_protos
+
+class ProtoLib(object):
+  # stands in for libtcod with the prototypes the MAC build installs: each
+  # function is a real ctypes function pointer, so arguments are checked and
+  # converted as they are against the dylib. Only the seeded RNG does anything
+  def __init__(self):
+    self.seeds = []
+
+    def new_from_seed(algo, seed):
+      self.seeds.append((algo, seed))
+      return 1
+
+    self.callbacks = [CFUNCTYPE(c_void_p, c_int, c_uint)(new_from_seed), CFUNCTYPE(None)(lambda: None)]
+    self.TCOD_random_new_from_seed = self.pointer(self.callbacks[0])
+
+  def pointer(self, callback):
+    return CFUNCTYPE(None)(cast(callback, c_void_p).value)
+
+  def __getattr__(self, name):
+    # every other function does nothing, it is only given its prototype
+    func = self.pointer(self.callbacks[1])
+    setattr(self, name, func)
+    return func
+
+class RandomSeedTest(unittest.TestCase):
+  def setUp(self):
+    self.lib = ProtoLib()
+    setup_protos(self.lib)
+    self.real_lib = libtcod._lib
+    libtcod._lib = self.lib
+
+  def tearDown(self):
+    libtcod._lib = self.real_lib
+
+  def test_new_from_seed_with_protos(self):
+    # the game seeds with any 32 bit unsigned value
+    seeds = [0, 1234, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF]
+    for seed in seeds:
+      self.assertEqual(libtcod.random_new_from_seed(seed), 1)
+    self.assertEqual(self.lib.seeds, [(libtcod.RNG_CMWC, seed) for seed in seeds])
+
+if __name__ == '__main__':
+  unittest.main()